@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmarks of Flask-Scss on synthetic asset trees.
+
+It generates a tree of assets (with deep directory nesting, chains of
+``@import`` and a large load path, like Compass), then measures:
+
+- ``cold_build``: ``update_scss`` when every asset is stale
+- ``noop_check``: ``update_scss`` when nothing changed
+- ``discover``: ``discover_scss`` alone
+- ``partials_check``: ``partials_have_changed`` alone
+- ``single_file_change``: ``update_scss`` after an asset has been modified
+- ``partial_change``: ``update_scss`` after a partial imported by a part of
+  the assets has been modified
+
+It also measures, in a new interpreter, the cost of the extension in a
+production process (``import``): the time taken by ``import flask_scss`` and
+by the creation of the extension, the memory they allocate, and whether
+pyScss has been imported.
+
+Results are written as JSON, so they can be compared between releases::
+
+  python bench_scss.py --assets 300 --output bench.json
+'''
+from __future__ import with_statement
+from __future__ import print_function
+import argparse
+import json
+import os
+import os.path as op
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from flask import Flask
+import flask_scss
+
+
+def write(path, content):
+    if not op.exists(op.dirname(path)):
+        os.makedirs(op.dirname(path))
+    with open(path, 'w') as file_out:
+        file_out.write(content)
+
+
+def generate_tree(root, assets, partials, depth, chain, load_path_files):
+    '''
+    Generates ``assets`` stylesheets spread over ``depth`` levels of
+    directories. Each asset imports a chain of ``chain`` partials, one of
+    ``partials`` shared partials and a file of the load path.
+    '''
+    asset_dir = op.join(root, 'assets')
+    load_path = op.join(root, 'vendor')
+    os.makedirs(op.join(root, 'static'))
+
+    for index in range(load_path_files):
+        write(op.join(load_path, 'lib%d' % (index % 10),
+                      '_module%d.scss' % index),
+              '@mixin module%d { margin: %dpx; }\n' % (index, index))
+    for index in range(chain):
+        next_import = '@import "chain%d";\n' % (index + 1) \
+                      if index + 1 < chain else ''
+        write(op.join(asset_dir, '_chain%d.scss' % index),
+              next_import + '$chain%d: %dpx;\n' % (index, index))
+    for index in range(partials):
+        write(op.join(asset_dir, 'partials', '_shared%d.scss' % index),
+              '.shared%d { padding: %dpx; }\n' % (index, index))
+    for index in range(assets):
+        folder = op.join(asset_dir,
+                         *['level%d' % level for level in range(index % depth)])
+        write(op.join(folder, 'asset%d.scss' % index),
+              '@import "chain0";\n'
+              '@import "partials/shared%d";\n'
+              '@import "lib%d/module%d";\n'
+              '.asset%d { @include module%d; width: $chain0; }\n'
+              % (index % partials, index % load_path_files % 10,
+                 index % load_path_files, index, index % load_path_files))
+    return asset_dir, load_path
+
+
+def timed(function, repeat=1, before=None):
+    timings = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    timings.sort()
+    return {
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'max': timings[-1],
+        'repeat': repeat,
+    }
+
+
+IMPORT_COST = '''
+import json, sys, time, tracemalloc
+import flask
+if %(traced)r:
+    tracemalloc.start()
+start = time.time()
+import flask_scss
+imported = time.time()
+flask_scss.Scss(flask.Flask('bench', root_path=%(root)r))
+created = time.time()
+print(json.dumps({
+    'import': imported - start,
+    'init': created - imported,
+    'allocated': tracemalloc.get_traced_memory()[1],
+    'pyscss_imported': 'scss' in sys.modules,
+}))
+'''
+
+
+def measure_import(root):
+    '''
+    Measures the import and creation of the extension for a production
+    application, in new interpreters: one for the times, one for the memory
+    (tracing allocations slows the import down).
+    '''
+    results = {}
+    for traced in (False, True):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_COST % {'traced': traced,
+                                                  'root': root}],
+            cwd=op.dirname(op.abspath(__file__)))
+        measure = json.loads(output.decode('utf-8'))
+        if traced:
+            results['allocated'] = measure['allocated']
+        else:
+            results.update(measure, allocated=None)
+    return results
+
+
+def touch(path):
+    mtime = time.time() + 1
+    os.utime(path, (mtime, mtime))
+
+
+def run(args):
+    root = tempfile.mkdtemp(prefix='flask-scss-bench-')
+    try:
+        asset_dir, load_path = generate_tree(
+            root, args.assets, args.partials, args.depth, args.chain,
+            args.load_path_files)
+        app = Flask(__name__, root_path=root)
+        app.config['SCSS_LOAD_PATHS'] = [load_path]
+        app.config['SCSS_WORKERS'] = args.workers
+        results = {'import': measure_import(root)}
+        scss = flask_scss.Scss(app)
+        try:
+            results['cold_build'] = timed(scss.update_scss)
+            results['noop_check'] = timed(scss.update_scss, args.repeat)
+            results['discover'] = timed(scss.discover_scss, args.repeat)
+            results['partials_check'] = timed(scss.partials_have_changed,
+                                              args.repeat)
+            asset = op.join(asset_dir, 'asset0.scss')
+            results['single_file_change'] = timed(
+                scss.update_scss, args.repeat, lambda: touch(asset))
+            partial = op.join(asset_dir, 'partials', '_shared0.scss')
+            results['partial_change'] = timed(
+                scss.update_scss, args.repeat, lambda: touch(partial))
+        finally:
+            scss.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict(vars(args), output=None),
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--assets', type=int, default=200)
+    parser.add_argument('--partials', type=int, default=50)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--chain', type=int, default=10)
+    parser.add_argument('--load-path-files', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None,
+                        help='JSON file for the results (default: stdout)')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    for name, timing in sorted(report['results'].items()):
+        if name == 'import':
+            print('%-20s %10.2f ms %10d B' % (
+                name, (timing['import'] + timing['init']) * 1000,
+                timing['allocated']), file=sys.stderr)
+            continue
+        print('%-20s %10.2f ms' % (name, timing['median'] * 1000),
+              file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
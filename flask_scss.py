@@ -2,9 +2,789 @@ from __future__ import with_statement
 from __future__ import absolute_import
 import os.path as op
 import os
-from scss.compiler import Compiler
+import stat
+import binascii
 import fnmatch
-import codecs
+import threading
+import multiprocessing
+import hashlib
+import json
+import tempfile
+import time
+import sys
+import io
+import re
+from itertools import product
+from pathlib import PurePosixPath
+import gzip
+from flask import url_for, request, has_request_context, abort, redirect
+from flask.signals import Namespace
+from collections import namedtuple, deque, OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import click
+except ImportError:
+    click = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# os.replace is not available on python 2
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _write_if_changed(path, data):
+    '''
+    Atomically replaces the content of ``path`` with the bytes ``data``,
+    through a temporary file, unless it already holds these bytes. Returns
+    True if the file was written. The mode of the previous file is kept, and
+    new files get the default mode of the process (0666 less its umask).
+    '''
+    try:
+        if op.getsize(path) == len(data):
+            with open(path, 'rb') as current:
+                if current.read() == data:
+                    return False
+    except (IOError, OSError):
+        pass
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = None
+    # Unlike mkstemp, which creates files readable by their owner only, this
+    # lets the kernel apply the umask, which cannot be read without being
+    # changed for the whole process
+    tmp_path = op.join(op.dirname(path), '.%s.%s' % (
+        op.basename(path), binascii.hexlify(os.urandom(6)).decode('ascii')))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        _replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return True
+
+def _gzip(data):
+    buf = io.BytesIO()
+    # A fixed mtime keeps the archive identical for identical css
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+                       fileobj=buf, mtime=0) as gz_file:
+        gz_file.write(data)
+    return buf.getvalue()
+
+#: Values allowed for ``SCSS_OUTPUT_STYLE``
+OUTPUT_STYLES = ('nested', 'expanded', 'compact', 'compressed')
+
+#: Metrics which can be limited by ``SCSS_BUDGETS``
+BUDGET_METRICS = ('bytes', 'gzip_bytes', 'rules', 'selectors')
+
+_html_mimetypes = ('text/html', 'application/xhtml+xml')
+
+_css_comment = re.compile(r'/\*.*?\*/', re.S)
+_css_block = re.compile(r'([^{};]*)\{')
+
+
+def css_metrics(css):
+    '''
+    Returns the size of ``css`` in bytes, once gzipped, and its number of
+    style rules and selectors (at-rules like ``@media`` are not counted, the
+    rules they contain are).
+    '''
+    data = css.encode('utf-8')
+    rules = selectors = 0
+    for match in _css_block.finditer(_css_comment.sub('', css)):
+        prelude = match.group(1).strip()
+        if not prelude or prelude.startswith('@'):
+            continue
+        rules += 1
+        selectors += len([selector for selector in prelude.split(',')
+                          if selector.strip()])
+    return {'bytes': len(data), 'gzip_bytes': len(_gzip(data)),
+            'rules': rules, 'selectors': selectors}
+
+#: Outcome of the compilation of an asset: ``duration`` is in seconds,
+#: ``size`` is the size of the css in bytes (None on error).
+CompileResult = namedtuple('CompileResult',
+                           'asset dest_path duration size error')
+
+_signals = Namespace()
+
+#: Sent before an asset is compiled, with ``asset`` and ``dest_path``.
+scss_compile_started = _signals.signal('scss-compile-started')
+#: Sent after an asset is compiled, with ``asset``, ``dest_path``,
+#: ``duration`` (in seconds), ``size`` (of the css, in bytes) and ``imports``
+#: (the number of imported files).
+scss_compile_finished = _signals.signal('scss-compile-finished')
+#: Sent when an asset fails to compile, with ``asset``, ``dest_path``,
+#: ``duration`` and ``error``.
+scss_compile_failed = _signals.signal('scss-compile-failed')
+#: Sent after the assets have been checked before a request, with
+#: ``duration``, ``assets`` (the number of known assets) and ``compiled``
+#: (the number of compiled assets).
+scss_check_finished = _signals.signal('scss-check-finished')
+
+
+class CompilationError(Exception):
+    '''
+    Raised when an asset compiled in a worker process fails to compile, or
+    when an asset that failed to compile has not changed since.
+    '''
+
+
+_pyscss = {}
+
+
+def _load_pyscss():
+    '''
+    Imports pyScss on first use, and returns a dict of the classes used by
+    Flask-Scss. Importing it takes a noticeable time and memory, which
+    processes only serving prebuilt css do not need to spend.
+    '''
+    if not _pyscss:
+        from scss.compiler import Compiler
+        from scss.extension import Extension
+        from scss.extension.core import CoreExtension
+        from scss.source import SourceFile
+        _pyscss.update(
+            Compiler=Compiler, Extension=Extension,
+            CoreExtension=CoreExtension, SourceFile=SourceFile,
+            ImportCache=type('ImportCache', (_ImportCache, Extension),
+                             {'__doc__': _ImportCache.__doc__}))
+    return _pyscss
+
+
+def __getattr__(name):
+    # flask_scss.SourceFile, flask_scss.ImportCache... import pyScss
+    if name in ('Compiler', 'Extension', 'CoreExtension', 'SourceFile',
+                'ImportCache'):
+        return _load_pyscss()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+class LRUCache(object):
+    '''
+    A dict keeping at most ``max_entries`` values, whose sizes (as given by
+    ``sizeof``) add up to at most ``max_bytes``: the least recently used
+    values are evicted first. Either limit can be None. The last value set
+    is always kept, even if it is larger than ``max_bytes``.
+    '''
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=len):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self.data[key] = self.data.pop(key)
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self._remove(key)
+            self.data[key] = value
+            self.sizes[key] = size = self.sizeof(value)
+            self.size += size
+            self.evict()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return list(self.data)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            value = self.data[key]
+            self._remove(key)
+            return value
+
+    def _remove(self, key):
+        if key in self.data:
+            del self.data[key]
+            self.size -= self.sizes.pop(key)
+
+    def evict(self):
+        while len(self.data) > 1 and (
+                (self.max_entries is not None
+                 and len(self.data) > self.max_entries)
+                or (self.max_bytes is not None
+                    and self.size > self.max_bytes)):
+            self._remove(next(iter(self.data)))
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.data), 'bytes': self.size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class DirectoryIndex(object):
+    '''
+    The files available under a directory of the search path, so that
+    finding an ``@import`` among its many candidate names is a matter of
+    dictionary lookups instead of failed ``stat`` calls.
+
+    :meth:`validate` walks the directories and lists again the ones whose
+    modification time changed (a file was added, removed or renamed in
+    them). Symbolic links to directories are not followed, as they may form
+    cycles: the files below them are looked up on the filesystem.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.dirs = {}
+        self.validated = 0
+
+    def validate(self):
+        self.validated = start = time.time()
+        dirs = {}
+        pending = [self.root]
+        while pending:
+            path = pending.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            listing = self.dirs.get(path)
+            # A directory modified within the resolution of its mtime may
+            # still change without its mtime moving.
+            if listing is None or listing[0] != mtime or mtime >= start - 1:
+                try:
+                    listing = (mtime,) + self.list(path)
+                except OSError:
+                    continue
+            dirs[path] = listing
+            pending.extend(op.join(path, name) for name in listing[2])
+        self.dirs = dirs
+
+    @staticmethod
+    def list(path):
+        '''
+        Returns the names of the entries of the directory ``path``, the list
+        of its subdirectories and the set of its symbolic links to
+        directories.
+        '''
+        subdirs, links = [], set()
+        if getattr(os, 'scandir', None) is None:
+            names = os.listdir(path)
+            for name in names:
+                if op.isdir(op.join(path, name)):
+                    if op.islink(op.join(path, name)):
+                        links.add(name)
+                    else:
+                        subdirs.append(name)
+            return frozenset(names), subdirs, frozenset(links)
+        # scandir tells directories apart without a stat call per entry
+        names = []
+        for entry in os.scandir(path):
+            names.append(entry.name)
+            if entry.is_dir():
+                if entry.is_symlink():
+                    links.add(entry.name)
+                else:
+                    subdirs.append(entry.name)
+        return frozenset(names), subdirs, frozenset(links)
+
+    def may_contain(self, relpath):
+        '''
+        Returns False if the file ``relpath`` (relative to the root) is known
+        not to exist.
+        '''
+        if relpath.startswith(os.pardir):
+            return True
+        folder, name = op.split(relpath)
+        listing = self.dirs.get(op.join(self.root, folder)
+                                if folder else self.root)
+        if listing is not None:
+            return name in listing[1]
+        # The folder is not indexed: it may be below a symbolic link
+        while folder:
+            folder, name = op.split(folder)
+            listing = self.dirs.get(op.join(self.root, folder)
+                                    if folder else self.root)
+            if listing is not None:
+                return name in listing[3]
+        return False
+
+
+class _ImportCache(object):
+    '''
+    A pyScss extension resolving ``@import`` like the core extension, but
+    keeping the source of each imported file (read, decoded and prepared by
+    pyScss) along with its modification time. A partial imported by many
+    assets is then read and prepared once per change, instead of once per
+    importing asset.
+
+    The candidate files are looked up in a :class:`DirectoryIndex` of each
+    directory of the search path, validated at most every ``index_ttl``
+    seconds, and right away when an import cannot be found.
+    '''
+    name = 'import_cache'
+    index_ttl = 1.0
+
+    def __init__(self):
+        self.sources = LRUCache(sizeof=lambda cached: len(cached[1].contents))
+        self.indexes = {}
+
+    def index(self, origin, refreshed=None):
+        '''
+        Returns the index of ``origin``. It is validated if it is too old, or
+        if ``refreshed`` (the set of the indexes validated for the current
+        lookup) does not hold it yet.
+        '''
+        index = self.indexes.get(origin)
+        if index is None:
+            index = self.indexes[origin] = DirectoryIndex(str(origin))
+        if refreshed is not None and origin not in refreshed:
+            refreshed.add(origin)
+            index.validate()
+        elif time.time() - index.validated > self.index_ttl:
+            index.validate()
+        return index
+
+    def handle_import(self, name, compilation, rule):
+        # Same lookup order as CoreExtension.handle_import
+        path = PurePosixPath(name)
+        search_exts = list(compilation.compiler.dynamic_extensions)
+        if path.suffix and path.suffix in search_exts:
+            basename = path.stem
+        else:
+            basename = path.name
+        relative_to = path.parent
+        search_path = []
+        if relative_to.is_absolute():
+            relative_to = PurePosixPath(*relative_to.parts[1:])
+        elif rule.source_file.origin:
+            search_path.append((
+                rule.source_file.origin,
+                rule.source_file.relpath.parent / relative_to,
+            ))
+        search_path.extend((origin, relative_to)
+                           for origin in compilation.compiler.search_path)
+
+        missed = []
+        source = self.find_import(basename, search_exts, search_path, rule,
+                                  missed)
+        if source is None:
+            # The file may have been created since the indexes were validated
+            del missed[:]
+            source = self.find_import(basename, search_exts, search_path,
+                                      rule, missed, refreshed=set())
+        # The candidates looked up before the file found would shadow it if
+        # they were created (see _compile_asset)
+        shadows = getattr(compilation, 'shadows', None)
+        if source is not None and shadows is not None:
+            shadows.update(missed)
+        return source
+
+    def find_import(self, basename, search_exts, search_path, rule, missed,
+                    refreshed=None):
+        for prefix, suffix in product(('_', ''), search_exts):
+            filename = prefix + basename + suffix
+            for origin, relative_to in search_path:
+                relpath = PurePosixPath(
+                    op.normpath(str(relative_to / filename)))
+                if rule.source_file.key == (origin, relpath):
+                    continue
+                if not self.index(origin, refreshed).may_contain(
+                        str(relpath)):
+                    missed.append(str(origin / relpath))
+                    continue
+                try:
+                    mtime = os.stat(str(origin / relpath)).st_mtime
+                except OSError:
+                    missed.append(str(origin / relpath))
+                    continue
+                return self.get_source(origin, relpath, mtime)
+
+    def forget(self, path):
+        '''
+        Drops the source of the file ``path`` (a real path), which has been
+        deleted.
+        '''
+        for origin, relpath in self.sources.keys():
+            if op.realpath(op.join(str(origin), str(relpath))) == path:
+                self.sources.pop((origin, relpath))
+
+    def get_source(self, origin, relpath, mtime):
+        cached = self.sources.get((origin, relpath))
+        if cached is None or cached[0] != mtime:
+            cached = mtime, _load_pyscss()['SourceFile'].read(origin,
+                                                              relpath)
+            self.sources[origin, relpath] = cached
+        return cached[1]
+
+
+def _make_compiler(compiler_options, sources_limits=(None, None)):
+    # The import cache comes before the extensions of the options (the core
+    # extension, by default), so it resolves the imports first.
+    pyscss = _load_pyscss()
+    options = dict(compiler_options)
+    extensions = tuple(options.pop('extensions', (pyscss['CoreExtension'],)))
+    import_cache = pyscss['ImportCache']()
+    import_cache.sources.max_entries, import_cache.sources.max_bytes = \
+        sources_limits
+    return pyscss['Compiler'](extensions=(import_cache,) + extensions,
+                              **options)
+
+
+def _import_cache(compiler):
+    for extension in compiler.extensions:
+        if isinstance(extension, _ImportCache):
+            return extension
+
+
+def _compile_asset(compiler, asset):
+    '''
+    Compiles ``asset`` with ``compiler`` and returns a tuple of the resulting
+    css, of the list of files imported during the compilation and of the
+    list of the missing files which would have been imported instead if they
+    existed. On errors, the files imported so far are listed in the
+    ``imported`` attribute of the exception.
+    '''
+    with open(asset) as file_in:
+        compilation = compiler.make_compilation()
+        compilation.add_source(
+            _load_pyscss()['SourceFile'].from_string(file_in.read()))
+    compilation.shadows = set()
+    try:
+        css = compiler.call_and_catch_errors(compilation.run)
+    except Exception as error:
+        error.imported = _imported_files(compilation)
+        raise
+    return css, _imported_files(compilation), sorted(compilation.shadows)
+
+
+def _imported_files(compilation):
+    # Every file resolved by an @import (in the asset dir or in one of the
+    # load paths) is added to the compilation sources.
+    return [source.path for source in compilation.sources if source.origin]
+
+
+_worker_compilers = {}
+
+
+def _compile_in_worker(compiler_options, asset, sources_limits=(None, None)):
+    # Compilers are kept between tasks, as each worker process is reused for
+    # many assets. Errors are sent back as text, as pyScss exceptions cannot
+    # always be pickled.
+    key = repr((sorted(compiler_options.items()), sources_limits))
+    if key not in _worker_compilers:
+        _worker_compilers[key] = _make_compiler(compiler_options,
+                                                sources_limits)
+    start = time.time()
+    try:
+        css, imported, shadows = _compile_asset(_worker_compilers[key], asset)
+    except Exception as error:
+        return (None, getattr(error, 'imported', None), None,
+                time.time() - start, str(error))
+    return css, imported, shadows, time.time() - start, None
+
+
+class BaseCache(object):
+    '''
+    Interface of the cache backends, where compiled css and the list of the
+    files imported by each asset are shared between the processes (and
+    possibly the hosts) using it. Keys are strings and values are bytes.
+
+    A backend also provides the locks ensuring an asset is compiled by a
+    single process at a time: the first one publishes its result, which is
+    then reused by the others.
+    '''
+
+    def get(self, key):
+        '''
+        Returns the value stored under ``key``, or None.
+        '''
+        raise NotImplementedError
+
+    def set(self, key, value):
+        '''
+        Stores ``value`` under ``key``.
+        '''
+        raise NotImplementedError
+
+    def lock(self, name):
+        '''
+        Returns a lock shared by every user of the cache, with the
+        ``acquire(blocking=True)`` and ``release()`` methods of
+        :class:`threading.Lock`.
+        '''
+        raise NotImplementedError
+
+
+class SimpleCache(BaseCache):
+    '''
+    Keeps values in a dict. It is only shared by the threads of a process,
+    and mainly useful as an example, or for tests.
+    '''
+
+    def __init__(self):
+        self.values = {}
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def lock(self, name):
+        with self.locks_lock:
+            return self.locks.setdefault(name, threading.Lock())
+
+
+class FileSystemCache(BaseCache):
+    '''
+    Stores compilation results in a directory, so they survive process
+    restarts. Values are bytes stored under their key, and locks are files
+    locked with ``flock`` in its ``locks`` subdirectory.
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return op.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as cached:
+                return cached.read()
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, value):
+        path = self.path(key)
+        if not op.exists(op.dirname(path)):
+            os.makedirs(op.dirname(path))
+        _write_if_changed(path, value)
+
+    def lock(self, name):
+        return AssetLock(op.join(self.cache_dir, 'locks', '%s.lock' % name))
+
+
+class AssetLock(object):
+    '''
+    A lock held by a single thread of a process, and by a single process
+    through an exclusive ``flock`` on ``path`` where ``fcntl`` is available.
+
+    When ``private`` is set, the directory of ``path`` must belong to the
+    current user and be inaccessible to the others, as in a shared temporary
+    directory it may have been created by anyone. Otherwise, or when the
+    lock file cannot be opened, the lock only keeps the threads apart.
+    '''
+
+    def __init__(self, path, private=False):
+        self.path = path
+        self.private = private
+        self.thread_lock = threading.Lock()
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        if not self.thread_lock.acquire(blocking):
+            return False
+        if fcntl is None:
+            return True
+        try:
+            if not op.exists(op.dirname(self.path)):
+                os.makedirs(op.dirname(self.path), 0o700)
+            if self.private and not self.is_private(op.dirname(self.path)):
+                return True
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT
+                              | getattr(os, 'O_NOFOLLOW', 0), 0o666)
+        except (IOError, OSError):
+            # Without a lock file, only the threads are kept apart
+            return True
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX
+                                 | (0 if blocking else fcntl.LOCK_NB))
+        except (IOError, OSError):
+            os.close(self.fd)
+            self.fd = None
+            self.thread_lock.release()
+            if blocking:
+                raise
+            return False
+        return True
+
+    @staticmethod
+    def is_private(path):
+        info = os.lstat(path)
+        return stat.S_ISDIR(info.st_mode) \
+            and info.st_uid == os.getuid() \
+            and not info.st_mode & 0o077
+
+    def read(self):
+        '''
+        Returns the bytes stored in the lock file by :meth:`write`, or None
+        if the lock file could not be opened. The lock must be held.
+        '''
+        if self.fd is None:
+            return None
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def write(self, data):
+        '''
+        Replaces the content of the lock file with the bytes ``data``, which
+        are kept for the next holders of the lock. The lock must be held.
+        '''
+        if self.fd is None:
+            return
+        os.ftruncate(self.fd, 0)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class _ScssEventHandler(FileSystemEventHandler):
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if path:
+                self.watcher.mark(path)
+
+
+class Watcher(object):
+    '''
+    Watches directories for modified ``.scss`` files in the background and
+    keeps the list of changed paths until :meth:`drain` is called.
+
+    It relies on `watchdog <https://pypi.python.org/pypi/watchdog>`_ (inotify
+    on Linux) when it is installed, and falls back on a thread polling the
+    modification times of the files every ``interval`` seconds.
+    '''
+
+    def __init__(self, paths, interval=1.0):
+        self.paths = [path for path in paths if op.isdir(path)]
+        self.interval = interval
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.observer = None
+        self.thread = None
+        self.snapshot = {}
+
+    def start(self):
+        if Observer is not None:
+            self.observer = Observer()
+            handler = _ScssEventHandler(self)
+            for path in self.paths:
+                self.observer.schedule(handler, path, recursive=True)
+            self.observer.daemon = True
+            self.observer.start()
+            return
+        self.snapshot = self.scan()
+        self.thread = threading.Thread(target=self.poll)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        if self.thread is not None:
+            self.thread.join()
+
+    def mark(self, path):
+        if path.endswith('.scss'):
+            with self.lock:
+                self.dirty.add(path)
+
+    def drain(self):
+        '''
+        Returns the set of paths modified since the last call.
+        '''
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def scan(self):
+        snapshot = {}
+        for path in self.paths:
+            for folder, _, files in os.walk(path):
+                for filename in fnmatch.filter(files, '*.scss'):
+                    src_path = op.join(folder, filename)
+                    try:
+                        snapshot[src_path] = op.getmtime(src_path)
+                    except OSError:
+                        pass
+        return snapshot
+
+    def poll(self):
+        while not self.stopped.wait(self.interval):
+            snapshot = self.scan()
+            for path in set(snapshot) | set(self.snapshot):
+                if snapshot.get(path) != self.snapshot.get(path):
+                    self.mark(path)
+            self.snapshot = snapshot
 
 
 class Scss(object):
@@ -42,14 +822,133 @@ class Scss(object):
         self.static_dir = self.set_static_dir(static_dir)
         self.assets = {}
         self.partials = {}
+        self.dependencies = {}
+        self.dependents = {}
+        self.imports = {}
+        self.compiled = {}
+        self.failures = {}
+        # The missing files which would shadow an import of each asset
+        self.shadows = {}
+        self.error_css_enabled = app.config.get('SCSS_ERROR_CSS', False)
+        self.check_lock = threading.Lock()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.last_check = 0
+        self.last_check_duration = None
+        self.stats_lock = threading.Lock()
+        self.compile_stats = {}
+        self.check_durations = deque(maxlen=1000)
+        self.check_count = 0
+        self.check_total_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.check_interval = app.config.get('SCSS_CHECK_INTERVAL', 0)
+        self.skip_endpoints = app.config.get('SCSS_SKIP_ENDPOINTS', ())
+        self.check_html_only = app.config.get('SCSS_CHECK_HTML_ONLY', False)
+        self.watcher = None
+        self.watching = False
+        self.pool = None
+        self.pool_size = None
+        self.workers = app.config.get('SCSS_WORKERS', 1) \
+                       or multiprocessing.cpu_count()
+        self.background = app.config.get('SCSS_BACKGROUND', False)
+        self.queue = queue.Queue()
+        self.queued = set()
+        self.queued_lock = threading.Lock()
+        self.background_thread = None
+        self.state_lock = threading.RLock()
 
+        self.load_paths = load_paths or app.config.get('SCSS_LOAD_PATHS', [])
         load_path_list = ([self.asset_dir] if self.asset_dir else []) \
-                       + (load_paths or app.config.get('SCSS_LOAD_PATHS', []))
+                       + self.load_paths
 
         # pyScss.log = app.logger
-        self.compiler = Compiler(search_path=load_path_list)
+        self.compiler_options = dict(app.config.get('SCSS_COMPILER_OPTIONS',
+                                                    {}))
+        for option, setting in (('search_path', 'SCSS_LOAD_PATHS'),
+                                ('output_style', 'SCSS_OUTPUT_STYLE')):
+            if option in self.compiler_options:
+                raise ValueError("%r cannot be set in SCSS_COMPILER_OPTIONS,"
+                                 " use %s" % (option, setting))
+        self.compiler_options['search_path'] = load_path_list
+        # Readable css while developing, smaller css otherwise
+        output_style = app.config.get(
+            'SCSS_OUTPUT_STYLE',
+            'nested' if app.debug or app.testing else 'compressed')
+        if output_style not in OUTPUT_STYLES:
+            raise ValueError("SCSS_OUTPUT_STYLE must be one of %s, not %r"
+                             % (', '.join(OUTPUT_STYLES), output_style))
+        self.compiler_options['output_style'] = output_style
+        self.budgets = app.config.get('SCSS_BUDGETS', {})
+        for pattern, budget in self.budgets.items():
+            for metric in budget:
+                if metric not in BUDGET_METRICS:
+                    raise ValueError(
+                        "Unknown metric %r in the budget of %r, expected "
+                        "one of %s" % (metric, pattern,
+                                       ', '.join(BUDGET_METRICS)))
+        self.metrics = {}
+        self.over_budget = {}
+        self.report_file = app.config.get('SCSS_REPORT_FILE', None)
+        self._compiler = None
+        self.compiler_lock = threading.Lock()
+        cache_dir = app.config.get('SCSS_CACHE_DIR', None)
+        self.cache = app.config.get('SCSS_CACHE_BACKEND', None) \
+                     or (FileSystemCache(cache_dir) if cache_dir else None)
+        self.fingerprint = app.config.get('SCSS_FINGERPRINT', False)
+        self.manifest_path = op.join(
+            self.static_dir or '',
+            app.config.get('SCSS_MANIFEST', 'scss-manifest.json'))
+        self.manifest = self.load_manifest()
+        self.precompress = app.config.get('SCSS_PRECOMPRESS', False)
+        self.in_memory = app.config.get('SCSS_IN_MEMORY', False)
+        self.lazy = app.config.get('SCSS_LAZY', False)
+        self.lazy_hooked = False
+        self.memory = LRUCache(
+            app.config.get('SCSS_MEMORY_MAX_ENTRIES', None),
+            app.config.get('SCSS_MEMORY_MAX_BYTES', None),
+            sizeof=lambda entry: len(entry[0]))
+        self.sources_limits = (
+            app.config.get('SCSS_SOURCES_MAX_ENTRIES', None),
+            app.config.get('SCSS_SOURCES_MAX_BYTES', None))
+        self.removed = set()
+        self.bundles = {}
+        for name, members in app.config.get('SCSS_BUNDLES', {}).items():
+            self.register_bundle(name, members)
+        self.cache_control = app.config.get('SCSS_CACHE_CONTROL', 'no-cache')
+        if self.in_memory:
+            app.add_url_rule(
+                app.config.get('SCSS_URL_PREFIX', '/scss')
+                + '/<path:filename>', 'scss', self.serve_css)
+        app.add_template_global(self.scss_url, 'scss_url')
         if self.app.testing or self.app.debug:
             self.set_hooks()
+        self.ready = threading.Event()
+        self.warmup_thread = None
+        if app.config.get('SCSS_WARMUP', False) and self.asset_dir \
+                and (self.static_dir or self.in_memory):
+            self.warmup_thread = threading.Thread(target=self.warm_up)
+            self.warmup_thread.daemon = True
+            self.warmup_thread.start()
+        else:
+            self.ready.set()
+        if click is not None and getattr(app, 'cli', None) is not None:
+            app.cli.add_command(self.make_cli())
+
+    @property
+    def compiler(self):
+        '''
+        The pyScss compiler, created (and pyScss imported) on first use.
+        '''
+        with self.compiler_lock:
+            if self._compiler is None:
+                self._compiler = _make_compiler(self.compiler_options,
+                                                self.sources_limits)
+            return self._compiler
+
+    @property
+    def import_cache(self):
+        return _import_cache(self.compiler)
 
     def set_asset_dir(self, asset_dir):
         asset_dir = asset_dir \
@@ -76,52 +975,1300 @@ class Scss(object):
             self.app.logger.warning("The asset directory cannot be found."
                                     "Flask-Scss extension has been disabled")
             return
-        if self.static_dir is None:
+        if self.static_dir is None and not self.in_memory:
             self.app.logger.warning("The static directory cannot be found."
                                     "Flask-Scss extension has been disabled")
             return
         self.app.logger.info("Pyscss loaded!")
+        if self.lazy:
+            if not self.in_memory:
+                self.app.before_request(self.update_requested_scss)
+                self.lazy_hooked = True
+            return
+        if self.app.config.get('SCSS_WATCH', False):
+            self.watcher = Watcher(
+                [self.asset_dir] + list(self.load_paths),
+                self.app.config.get('SCSS_WATCH_INTERVAL', 1.0))
+            self.watcher.start()
         self.app.before_request(self.update_scss)
 
+    def make_cli(self):
+        '''
+        Returns the ``scss`` command group registered on the application's
+        ``flask`` command.
+        '''
+        scss = self
+
+        @click.group('scss', help='Flask-Scss commands.')
+        def cli():
+            pass
+
+        @cli.command('build', help='Compile every scss asset.')
+        @click.option('-j', '--workers', type=int, default=None,
+                      help='Number of compilation processes '
+                           '(default: SCSS_WORKERS).')
+        def build(workers):
+            if scss.asset_dir is None or scss.static_dir is None:
+                raise click.ClickException(
+                    "The asset or the static directory cannot be found.")
+            start = time.time()
+            try:
+                results = scss.build_all(workers=workers)
+            finally:
+                scss.close()
+            errors = 0
+            for result in results:
+                if result.error is not None:
+                    errors += 1
+                    click.echo("%8.1f ms %10s  %s: %s" % (
+                        result.duration * 1000, 'ERROR', result.asset,
+                        result.error), err=True)
+                else:
+                    click.echo("%8.1f ms %8d B  %s" % (
+                        result.duration * 1000, result.size,
+                        result.dest_path))
+            for name, exceeded in sorted(scss.over_budget.items()):
+                for message in exceeded:
+                    click.echo("%19s  %s: %s" % ('OVER BUDGET', name,
+                                                 message), err=True)
+            click.echo("%d assets compiled in %.1f ms, %d errors, "
+                       "%d over budget" % (
+                           len(results) - errors,
+                           (time.time() - start) * 1000, errors,
+                           len(scss.over_budget)))
+            if errors or scss.over_budget:
+                sys.exit(1)
+
+        return cli
+
+    def register_bundle(self, name, assets):
+        '''
+        Declares a bundle: the css of ``assets`` (a list of paths relative
+        to the asset directory, e.g. ``['foo.scss', 'bar/baz.scss']``),
+        concatenated in this order into the css file ``name`` (relative to
+        the static directory, e.g. ``all.css``). The bundle is rebuilt when
+        one of its members is recompiled.
+        '''
+        self.bundles[name] = [op.join(self.asset_dir or '', *asset.split('/'))
+                              for asset in assets]
+
+    def bundle_path(self, name):
+        if self.in_memory:
+            return name
+        return op.join(self.static_dir, *name.split('/'))
+
+    def update_bundles(self, results, raise_errors=True, rebuild=False,
+                       names=None):
+        '''
+        Rebuilds the bundles having a member among the successful ``results``
+        of a compilation, or no css yet (or every bundle, if ``rebuild`` is
+        True), and returns the list of :class:`CompileResult` of the bundles.
+        Only the bundles listed in ``names`` are considered, if it is given.
+        '''
+        compiled = set(result.asset for result in results
+                       if result.error is None)
+        bundle_results = []
+        for name in sorted(self.bundles if names is None else names):
+            members = self.bundles[name]
+            dest_path = self.bundle_path(name)
+            if not rebuild and not compiled.intersection(members) \
+                    and self.has_output(dest_path):
+                continue
+            start = time.time()
+            try:
+                css = self.build_bundle(name)
+            except Exception as error:
+                if raise_errors:
+                    raise
+                bundle_results.append(CompileResult(
+                    name, dest_path, time.time() - start, None, error))
+                continue
+            bundle_results.append(CompileResult(
+                name, dest_path, time.time() - start,
+                len(css.encode('utf-8')), None))
+        return bundle_results
+
+    def refresh_bundle(self, name):
+        '''
+        Compiles the stale members of the bundle ``name`` and rebuilds it if
+        needed. Returns the list of :class:`CompileResult`.
+        '''
+        with self.state_lock:
+            stale = {}
+            for asset in self.bundles[name]:
+                dest_path = self.assets.setdefault(asset,
+                                                   self.dest_path(asset))
+                if self.is_stale(asset, dest_path):
+                    stale[asset] = dest_path
+        results = self.refresh(stale)
+        return results + self.update_bundles(results, names=[name])
+
+    def build_bundle(self, name):
+        '''
+        Concatenates the css of the members of the bundle ``name``, compiling
+        the ones without css, and writes it.
+        '''
+        dest_path = self.bundle_path(name)
+        with self.asset_lock(name, dest_path):
+            parts = []
+            for asset in self.bundles[name]:
+                with self.state_lock:
+                    member_path = self.assets.setdefault(
+                        asset, self.dest_path(asset))
+                if not self.has_output(member_path):
+                    self.compile_scss(asset, member_path)
+                parts.append(self.read_output(member_path))
+            css = '\n'.join(parts)
+            self.app.logger.info("[flask-pyscss] refreshing %s" % (dest_path,))
+            self.write_output(dest_path, css.encode('utf-8'))
+        self.measure(dest_path, css)
+        return css
+
     def discover_scss(self):
+        found = set()
         for folder, _, files in os.walk(self.asset_dir):
             for filename in fnmatch.filter(files, '*.scss'):
                 src_path = op.join(folder, filename)
+                found.add(src_path)
                 if filename.startswith('_') and src_path not in self.partials:
                     self.partials[src_path] = op.getmtime(src_path)
                 elif src_path not in self.partials and src_path not in self.assets:
-                    dest_path = src_path.replace(
-                                    self.asset_dir,
-                                    self.static_dir
-                                ).replace('.scss', '.css')
-                    self.assets[src_path] = dest_path
+                    self.assets[src_path] = self.dest_path(src_path)
+        for partial in set(self.partials) - found:
+            del self.partials[partial]
+            self.removed.add(partial)
+        for asset in set(self.assets) - found:
+            self.forget_asset(asset)
+
+    def forget_asset(self, asset):
+        '''
+        Drops an asset whose source has been deleted, along with its css
+        kept in memory or the compressed variants of its output, its lock
+        and its statistics.
+        '''
+        dest_path = self.assets.pop(asset)
+        self.record_dependencies(asset, [])
+        del self.dependencies[asset]
+        self.compiled.pop(asset, None)
+        self.failures.pop(asset, None)
+        self.shadows.pop(asset, None)
+        with self.locks_lock:
+            self.locks.pop(asset, None)
+        with self.stats_lock:
+            self.compile_stats.pop(asset, None)
+            self.metrics.pop(self.css_name(dest_path), None)
+            self.over_budget.pop(self.css_name(dest_path), None)
+        if self.in_memory:
+            self.memory.pop(dest_path, None)
+        else:
+            self.remove_compressed(self.output_path(dest_path))
+
+    def dest_path(self, src_path):
+        if self.in_memory:
+            # Assets are only known by their name, e.g. foo/bar.css
+            return op.relpath(src_path, self.asset_dir).replace(
+                os.sep, '/')[:-len('.scss')] + '.css'
+        return src_path.replace(self.asset_dir,
+                                self.static_dir).replace('.scss', '.css')
+
+    def apply_changes(self, changed):
+        '''
+        Updates the known assets, partials and imported files from a set of
+        paths reported as modified, created or deleted by the watcher.
+        '''
+        for path in changed:
+            exists = op.exists(path)
+            if not exists:
+                self.forget_source(path)
+            if path in self.imports:
+                if exists:
+                    self.imports[path] = op.getmtime(path)
+                else:
+                    del self.imports[path]
+            if not path.startswith(op.join(self.asset_dir, '')):
+                continue
+            if not exists:
+                self.partials.pop(path, None)
+                if path in self.assets:
+                    self.forget_asset(path)
+            elif op.basename(path).startswith('_'):
+                self.partials[path] = op.getmtime(path)
+            elif path not in self.assets:
+                self.assets[path] = self.dest_path(path)
+
+    def changed_partials(self):
+        '''
+        Returns the list of partials and imported files whose modification
+        time has moved since they were last seen, or which have been deleted,
+        and records their new modification time.
+        '''
+        changed, self.removed = list(self.removed), set()
+        for tracked in (self.partials, self.imports):
+            for path, old_mtime in list(tracked.items()):
+                try:
+                    cur_mtime = op.getmtime(path)
+                except OSError:
+                    del tracked[path]
+                    changed.append(path)
+                    continue
+                if cur_mtime > old_mtime:
+                    changed.append(path)
+                    tracked[path] = cur_mtime
+        for path in changed:
+            if not op.exists(path):
+                self.forget_source(path)
+        return changed
+
+    def forget_source(self, path):
+        '''
+        Drops the source of a deleted partial or imported file kept by the
+        compiler.
+        '''
+        if self._compiler is not None:
+            self.import_cache.forget(op.realpath(path))
 
     def partials_have_changed(self):
-        res = False
-        for partial, old_mtime in self.partials.items():
-            cur_mtime = op.getmtime(partial)
-            if cur_mtime > old_mtime:
-                res = True
-                self.partials[partial] = cur_mtime
-        return res
+        return bool(self.changed_partials())
+
+    def affected_assets(self, changed):
+        '''
+        Returns the assets that must be recompiled because one of the
+        ``changed`` files is among their (transitive) imports.
+
+        Assets that have not been compiled yet have unknown dependencies, so
+        they are considered affected by any change to a partial.
+        '''
+        affected = set()
+        if any(path not in self.assets for path in changed):
+            affected.update(asset for asset in self.assets
+                            if asset not in self.dependencies)
+        for path in changed:
+            affected.update(self.dependents.get(op.realpath(path), ()))
+        return affected
+
+    def record_dependencies(self, asset, imported):
+        '''
+        Stores the set of files ``asset`` imported during its last compilation
+        and updates the reverse-dependency index accordingly.
+        '''
+        imported = set(op.realpath(path) for path in imported)
+        for path in self.dependencies.get(asset, set()) - imported:
+            self.dependents.get(path, set()).discard(asset)
+            if not self.dependents.get(path):
+                self.dependents.pop(path, None)
+                self.imports.pop(path, None)
+        for path in imported:
+            self.dependents.setdefault(path, set()).add(asset)
+            if path not in self.partials and path not in self.imports \
+                    and op.exists(path):
+                self.imports[path] = op.getmtime(path)
+        self.dependencies[asset] = imported
 
     def update_scss(self):
-        self.discover_scss()
-        if self.partials_have_changed():
-            for asset, dest_path in self.assets.items():
-                self.compile_scss(asset, dest_path)
+        '''
+        Refreshes the stale css files. This is the ``before_request`` hook.
+
+        Requests to the endpoints listed in ``SCSS_SKIP_ENDPOINTS`` (and to
+        requests not preferring HTML if ``SCSS_CHECK_HTML_ONLY`` is set) are
+        ignored, and the check runs at most once every ``SCSS_CHECK_INTERVAL``
+        seconds. The time spent in the last check is kept in
+        ``last_check_duration``.
+        '''
+        if has_request_context() and self.skip_request():
             return
+        start = time.time()
+        with self.check_lock:
+            if start - self.last_check < self.check_interval:
+                return
+            self.last_check = start
+        results = self.check_scss()
+        self.check_finished(start, len(results))
+
+    def check_finished(self, start, compiled):
+        '''
+        Records the duration of a check and sends ``scss_check_finished``.
+        '''
+        self.last_check_duration = duration = time.time() - start
+        with self.stats_lock:
+            self.check_durations.append(duration)
+            self.check_count += 1
+            self.check_total_time += duration
+        self.app.logger.debug("[flask-pyscss] assets checked in %.1f ms" % (
+            duration * 1000,))
+        scss_check_finished.send(self.app, duration=duration,
+                                 assets=len(self.assets), compiled=compiled)
+
+    def skip_request(self):
+        if request.endpoint in self.skip_endpoints:
+            return True
+        return self.check_html_only and not self.accepts_html()
+
+    def accepts_html(self):
+        '''
+        Tells whether the current request prefers HTML: an HTML type must be
+        listed in its ``Accept`` header with the highest quality. Wildcards
+        do not count, as browsers send them for stylesheets and images too.
+        '''
+        accept = request.accept_mimetypes
+        html = [quality for value, quality in accept
+                if value in _html_mimetypes]
+        return bool(html) and max(html) >= max(q for _, q in accept)
+
+    def check_scss(self):
+        with self.state_lock:
+            stale = self.stale_assets()
+        results = self.refresh(stale)
+        return results + self.update_bundles(results)
+
+    def stale_assets(self):
+        '''
+        Returns a dict of the assets that must be recompiled, mapped to their
+        destination paths.
+        '''
+        if self.watching:
+            changed = self.watcher.drain()
+            if not changed:
+                return {}
+            self.apply_changes(changed)
+            affected = self.affected_assets(changed)
+            affected.update(path for path in changed if path in self.assets)
+            return dict((asset, self.assets[asset]) for asset in affected)
+        self.watching = self.watcher is not None
+        self.discover_scss()
+        affected = self.affected_assets(self.changed_partials())
+        stale = {}
         for asset, dest_path in self.assets.items():
-            dest_mtime = op.getmtime(dest_path) \
-                             if op.exists(dest_path) \
-                             else -1
-            if op.getmtime(asset) > dest_mtime:
-                self.compile_scss(asset, dest_path)
+            if asset in affected:
+                stale[asset] = dest_path
+                continue
+            if op.getmtime(asset) > self.compiled_time(asset, dest_path):
+                stale[asset] = dest_path
+        return stale
+
+    def refresh(self, stale):
+        '''
+        Compiles a dict of stale assets and returns the list of
+        :class:`CompileResult`.
+
+        When ``SCSS_BACKGROUND`` is set, the assets that already have a css
+        output are queued for the background thread instead, and keep being
+        served with their previous css until it is replaced. Only the assets
+        that have never been compiled are compiled right away.
+        '''
+        if self.background:
+            missing = dict((asset, dest_path)
+                           for asset, dest_path in stale.items()
+                           if not self.has_output(dest_path))
+            self.compile_in_background(dict(
+                (asset, dest_path) for asset, dest_path in stale.items()
+                if asset not in missing))
+            stale = missing
+        results = self.compile_many(
+            stale, raise_errors=not self.error_css_enabled)
+        self.show_errors(results)
+        return results
+
+    def show_errors(self, results):
+        '''
+        Replaces the css of the assets that failed to compile by
+        :meth:`error_css` when ``SCSS_ERROR_CSS`` is set.
+        '''
+        if not self.error_css_enabled:
+            return
+        for result in results:
+            if result.error is not None:
+                self.write_output(result.dest_path, self.error_css(
+                    result.error).encode('utf-8'))
+
+    def has_output(self, dest_path):
+        if self.in_memory:
+            return dest_path in self.memory
+        return self.output_mtime(dest_path) is not None
+
+    def compile_in_background(self, assets):
+        '''
+        Queues a dict of assets for the background thread, which is started
+        on first use. Assets already waiting in the queue are not queued
+        twice.
+        '''
+        with self.queued_lock:
+            assets = dict((asset, dest_path)
+                          for asset, dest_path in assets.items()
+                          if asset not in self.queued)
+            if not assets:
+                return
+            self.queued.update(assets)
+            if self.background_thread is None:
+                self.background_thread = threading.Thread(
+                    target=self.run_background)
+                self.background_thread.daemon = True
+                self.background_thread.start()
+        self.queue.put(assets)
+
+    def run_background(self):
+        while True:
+            assets = self.queue.get()
+            if assets is None:
+                self.queue.task_done()
+                return
+            try:
+                results = self.compile_many(assets, raise_errors=False)
+                self.show_errors(results)
+                for result in results + self.update_bundles(
+                        results, raise_errors=False):
+                    if result.error is not None:
+                        self.app.logger.error(
+                            "[flask-pyscss] %s: %s" % (result.asset,
+                                                       result.error))
+            except Exception:
+                # e.g. the cache backend is unavailable: the assets are
+                # queued again at the next check, the thread must go on.
+                self.app.logger.exception(
+                    "[flask-pyscss] background compilation failed")
+            finally:
+                # Assets modified during their compilation are stale again
+                # at the next check, and queued once more.
+                with self.queued_lock:
+                    self.queued.difference_update(assets)
+                self.queue.task_done()
+
+    def compiled_time(self, asset, dest_path):
+        '''
+        Returns the time of the last compilation of ``asset``: the
+        modification time of its output, or the time its last compilation
+        started if it is more recent (identical css is not rewritten). Only
+        the latter exists for css kept in memory.
+        '''
+        if self.in_memory:
+            return self.compiled.get(asset, -1)
+        output = self.output_path(dest_path)
+        dest_mtime = op.getmtime(output) \
+                         if op.exists(output) \
+                         else -1
+        return max(dest_mtime, self.compiled.get(asset, -1))
+
+    def is_stale(self, asset, dest_path):
+        '''
+        Checks the modification time of ``asset`` and of all the files it
+        imports against its last compilation. Assets whose imports are not
+        known yet are always stale.
+        '''
+        if asset not in self.dependencies:
+            return True
+        compiled = self.compiled_time(asset, dest_path)
+        try:
+            return any(op.getmtime(path) > compiled
+                       for path in [asset] + list(self.dependencies[asset]))
+        except OSError:
+            return True
+
+    def find_asset(self, name):
+        '''
+        Returns the path of the asset compiled to the css file ``name``
+        (e.g. ``foo/bar.css``), or None if there is no such asset.
+        '''
+        if self.asset_dir is None or not name.endswith('.css'):
+            return None
+        asset = op.normpath(op.join(self.asset_dir, *name.split('/')))
+        asset = asset[:-len('.css')] + '.scss'
+        if not asset.startswith(op.join(self.asset_dir, '')) \
+                or op.basename(asset).startswith('_') \
+                or not op.isfile(asset):
+            return None
+        return asset
+
+    def update_requested_scss(self):
+        '''
+        The ``before_request`` hook of the lazy mode (``SCSS_LAZY``): only
+        the asset matching the requested static css file is checked, and
+        compiled if it is stale.
+
+        With ``SCSS_FINGERPRINT``, requests to the css of an asset under its
+        name (``foo.css``) or under a previous fingerprinted name are
+        redirected to its current fingerprinted name.
+        '''
+        if request.endpoint != 'static':
+            return
+        path = op.normpath(op.join(
+            self.app.root_path, self.app.static_folder,
+            *request.view_args['filename'].split('/')))
+        if not path.startswith(op.join(self.static_dir, '')):
+            return
+        name = op.relpath(path, self.static_dir).replace(os.sep, '/')
+        logical_name = self.unfingerprinted(name)
+        if not self.refresh_requested(logical_name):
+            return
+        if self.fingerprint \
+                and self.manifest.get(logical_name, name) != name:
+            return redirect(self.scss_url(logical_name))
+
+    def unfingerprinted(self, name):
+        '''
+        Returns the name of the css file ``name`` without its fingerprint,
+        found in the manifest when ``SCSS_FINGERPRINT`` is set.
+        '''
+        if not self.fingerprint or name in self.manifest:
+            return name
+        for logical_name, output_name in list(self.manifest.items()):
+            if output_name == name:
+                return logical_name
+        return name
+
+    def refresh_requested(self, name):
+        '''
+        Checks, and compiles if it is stale, the asset or the bundle whose
+        css file is ``name`` (e.g. ``foo/bar.css``). Returns False if there
+        is no such asset or bundle.
+        '''
+        start = time.time()
+        if name in self.bundles:
+            self.check_finished(start, len(self.refresh_bundle(name)))
+            return True
+        asset = self.find_asset(name)
+        if asset is None:
+            return False
+        with self.state_lock:
+            dest_path = self.assets.setdefault(asset, self.dest_path(asset))
+            stale = self.is_stale(asset, dest_path)
+        compiled = len(self.refresh({asset: dest_path})) if stale else 0
+        self.check_finished(start, compiled)
+        return True
+
+    def warm_up(self):
+        '''
+        Discovers the assets and compiles the stale ones (with
+        ``SCSS_WORKERS`` processes), then sets ``ready``. It is run in the
+        background at the creation of the extension when ``SCSS_WARMUP`` is
+        set.
+        '''
+        try:
+            start = time.time()
+            with self.state_lock:
+                stale = self.stale_assets()
+            results = self.compile_many(stale, raise_errors=False)
+            self.show_errors(results)
+            results += self.update_bundles(results, raise_errors=False)
+            for result in results:
+                if result.error is not None:
+                    self.app.logger.error("[flask-pyscss] %s: %s" % (
+                        result.asset, result.error))
+            self.app.logger.info(
+                "[flask-pyscss] %d assets compiled in %.1f ms at startup" % (
+                    len(results), (time.time() - start) * 1000))
+        finally:
+            self.ready.set()
+
+    def wait_until_warm(self, timeout=None):
+        '''
+        Blocks until the warm-up started by ``SCSS_WARMUP`` is over, or for
+        ``timeout`` seconds. Returns True if it is over.
+        '''
+        return self.ready.wait(timeout)
+
+    def compile_many(self, assets, workers=None, raise_errors=True):
+        '''
+        Compiles a dict of assets to their destination paths and returns a
+        list of :class:`CompileResult`. When more than one worker is
+        configured (see ``SCSS_WORKERS``), the compilations are distributed
+        over a pool of processes and the results are written back from the
+        current process.
+
+        Errors are raised, unless ``raise_errors`` is False, in which case
+        they are only reported in the results.
+        '''
+        workers = workers or self.workers
+        tasks = {}
+        locks = {}
+        started = time.time()
+        try:
+            if workers > 1 and len(assets) > 1:
+                self._dispatch(assets, tasks, locks, workers)
+            return self._collect_results(assets, tasks, locks, started,
+                                         raise_errors)
+        finally:
+            for lock in locks.values():
+                lock.release()
+
+    def _dispatch(self, assets, tasks, locks, workers):
+        pool = self.get_pool(workers)
+        for asset, dest_path in assets.items():
+            lock = self.asset_lock(asset, dest_path)
+            # Assets being compiled by another thread or process are left to
+            # compile_scss, which waits for them, as well as the assets whose
+            # last compilation failed with the same inputs.
+            if self.failure(asset) is not None \
+                    or not lock.acquire(blocking=False):
+                continue
+            if self.compiled_elsewhere(asset, dest_path):
+                # Left to compile_scss, which reuses it
+                lock.release()
+                continue
+            locks[asset] = lock
+            # As in compile_scss, css found in the cache is a compilation too
+            self.compile_started(asset, dest_path)
+            cached = self.load_cached(asset)
+            if cached is not None:
+                tasks[asset] = cached
+                continue
+            tasks[asset] = pool.apply_async(
+                _compile_in_worker, (self.compiler_options, asset,
+                                     self.sources_limits))
+
+    def _collect_results(self, assets, tasks, locks, started, raise_errors):
+        results = []
+        for asset, dest_path in sorted(assets.items()):
+            task = tasks.get(asset)
+            start = time.time()
+            try:
+                if task is None:
+                    css = self.compile_scss(asset, dest_path)
+                    duration = time.time() - start
+                elif isinstance(task, tuple):
+                    css = self.write_scss(asset, dest_path, *task,
+                                          started=started)
+                    duration = time.time() - start
+                    self.compile_finished(asset, dest_path, duration, css,
+                                          task[1])
+                else:
+                    css, imported, shadows, duration, error = task.get()
+                    if error is not None:
+                        error = CompilationError("%s: %s" % (asset, error))
+                        error.imported = imported
+                        self.compile_failed(asset, dest_path, duration, error)
+                        raise error
+                    self.shadows[asset] = shadows
+                    self.store_cached(asset, css, imported, started)
+                    self.write_scss(asset, dest_path, css, imported,
+                                    started=started)
+                    self.compile_finished(asset, dest_path, duration, css,
+                                          imported)
+                if asset in locks:
+                    locks.pop(asset).release()
+            except Exception as error:
+                if raise_errors:
+                    raise
+                results.append(CompileResult(asset, dest_path,
+                                             time.time() - start, None, error))
+                continue
+            results.append(CompileResult(asset, dest_path, duration,
+                                         len(css.encode('utf-8')), None))
+        return results
+
+    def get_pool(self, workers):
+        if self.pool is not None and self.pool_size != workers:
+            self.pool.terminate()
+            self.pool = None
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(workers)
+            self.pool_size = workers
+        return self.pool
+
+    def build_all(self, workers=None):
+        '''
+        Discovers and compiles every asset and bundle, whether it is stale or
+        not, and returns the list of :class:`CompileResult`. Compilation
+        errors do not stop the build, they are reported in the results. The
+        metrics of the css are appended to ``SCSS_REPORT_FILE``, if set, and
+        the previous fingerprinted files are removed.
+
+        :param workers: The number of processes to use (defaults to
+                        ``SCSS_WORKERS``)
+        '''
+        self.discover_scss()
+        results = self.compile_many(self.assets, workers=workers,
+                                    raise_errors=False)
+        results += self.update_bundles(results, raise_errors=False,
+                                       rebuild=True)
+        if self.fingerprint and not self.in_memory:
+            self.prune_fingerprinted()
+        if self.report_file:
+            self.write_report()
+        return results
+
+    def close(self):
+        '''
+        Stops the background watcher, the background compilation thread and
+        the process pool, if any, after the end of the warm-up.
+        '''
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self.warmup_thread is not None:
+            self.warmup_thread.join()
+            self.warmup_thread = None
+        if self.background_thread is not None:
+            self.queue.put(None)
+            self.background_thread.join()
+            self.background_thread = None
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
 
     def compile_scss(self, asset, dest_path):
+        compiled = self.compiled.get(asset)
+        output_mtime = self.output_mtime(dest_path)
+        with self.asset_lock(asset, dest_path):
+            if self.compiled.get(asset) != compiled \
+                    or self.output_mtime(dest_path) != output_mtime:
+                # Another thread or process compiled it while we waited
+                imported = self.cached_imports(asset)
+                if imported is not None:
+                    with self.state_lock:
+                        self.record_dependencies(asset, imported)
+                return self.read_output(dest_path)
+            if self.compiled_elsewhere(asset, dest_path):
+                return self.read_output(dest_path)
+            failure = self.failure(asset)
+            if failure is not None:
+                raise CompilationError(failure)
+            started = time.time()
+            self.compile_started(asset, dest_path)
+            try:
+                css, imported = self.compile_css(asset)
+            except Exception as error:
+                self.compile_failed(asset, dest_path, time.time() - started,
+                                    error)
+                raise
+            css = self.write_scss(asset, dest_path, css, imported,
+                                  started=started)
+            self.compile_finished(asset, dest_path, time.time() - started,
+                                  css, imported)
+            return css
+
+    def compile_started(self, asset, dest_path):
+        scss_compile_started.send(self.app, asset=asset, dest_path=dest_path)
+
+    def compile_finished(self, asset, dest_path, duration, css, imported):
+        size = len(css.encode('utf-8'))
+        with self.stats_lock:
+            stats = self.compile_stats.setdefault(asset, {
+                'count': 0, 'failures': 0, 'total_time': 0.0})
+            stats['count'] += 1
+            stats['total_time'] += duration
+            stats['last_time'] = duration
+            stats['size'] = size
+        self.measure(dest_path, css)
+        scss_compile_finished.send(self.app, asset=asset, dest_path=dest_path,
+                                   duration=duration, size=size,
+                                   imports=len(imported))
+
+    def css_name(self, dest_path):
+        if self.in_memory:
+            return dest_path
+        return self.logical_name(dest_path)
+
+    def measure(self, dest_path, css):
+        '''
+        Records the :func:`css_metrics` of the css written to ``dest_path``
+        and checks them against the budgets matching its name (see
+        ``SCSS_BUDGETS``). Exceeded budgets are logged, and kept in
+        ``over_budget`` until the css is back within them.
+        '''
+        name = self.css_name(dest_path)
+        metrics = css_metrics(css)
+        exceeded = []
+        for pattern, budget in sorted(self.budgets.items()):
+            if not fnmatch.fnmatch(name, pattern):
+                continue
+            for metric, limit in sorted(budget.items()):
+                if metrics[metric] > limit:
+                    exceeded.append("%s %d > %d (%s)" % (
+                        metric, metrics[metric], limit, pattern))
+        with self.stats_lock:
+            self.metrics[name] = metrics
+            if exceeded:
+                self.over_budget[name] = exceeded
+            else:
+                self.over_budget.pop(name, None)
+        for message in exceeded:
+            self.app.logger.warning("[flask-pyscss] %s is over budget: %s"
+                                    % (name, message))
+        return metrics
+
+    def write_report(self):
+        '''
+        Appends the metrics of every css file, as a line of JSON, to
+        ``SCSS_REPORT_FILE``, to follow their size from build to build.
+        '''
+        with self.stats_lock:
+            report = {'time': time.time(),
+                      'css': dict(self.metrics),
+                      'over_budget': dict(self.over_budget)}
+        with open(self.report_file, 'a') as report_file:
+            report_file.write(json.dumps(report, sort_keys=True) + '\n')
+
+    def compile_failed(self, asset, dest_path, duration, error):
+        self.record_failure(asset, getattr(error, 'imported', None), error)
+        with self.stats_lock:
+            stats = self.compile_stats.setdefault(asset, {
+                'count': 0, 'failures': 0, 'total_time': 0.0})
+            stats['failures'] += 1
+            stats['total_time'] += duration
+        scss_compile_failed.send(self.app, asset=asset, dest_path=dest_path,
+                                 duration=duration, error=error)
+
+    def record_failure(self, asset, imported, error):
+        '''
+        Records that ``asset`` failed to compile, so it is not compiled again
+        until its inputs change (see :meth:`failure`). ``imported`` lists the
+        files imported before the error, if they are known.
+        '''
+        if imported is None:
+            imported = self.dependencies.get(asset, ())
+        else:
+            with self.state_lock:
+                self.record_dependencies(asset, imported)
+        key = self.failure_key(asset, imported)
+        if key is not None:
+            self.failures[asset] = key, list(imported), \
+                                   '%s: %s' % (asset, error)
+
+    def failure(self, asset):
+        '''
+        Returns the error message of the last compilation of ``asset`` if it
+        failed and neither the asset, nor the files it imported, nor the list
+        of partials changed since. Returns None otherwise.
+        '''
+        failure = self.failures.get(asset)
+        if failure is None:
+            return None
+        key, imported, message = failure
+        if self.failure_key(asset, imported) != key:
+            self.failures.pop(asset, None)
+            return None
+        return message
+
+    def failure_key(self, asset, imported):
+        # A new partial may be the missing import that caused the error
+        key = self.input_key(asset, imported)
+        if key is None:
+            return None
+        return hashlib.sha1('\n'.join([key] + sorted(self.partials))
+                            .encode('utf-8')).hexdigest()
+
+    def error_css(self, error):
+        '''
+        Returns css displaying ``error`` at the top of the pages using it.
+        '''
+        message = ('%s' % (error,)).replace('\\', '\\\\') \
+            .replace('"', '\\"').replace('\n', '\\A ')
+        return ('body:before { content: "%s"; display: block; '
+                'white-space: pre-wrap; padding: 1em; color: #900; '
+                'background: #fee; font: 12px monospace; }\n' % (message,))
+
+    def stats(self):
+        '''
+        Returns a snapshot of the statistics of this instance:
+
+        - ``compilations``: per asset, the number of compilations and
+          failures, the cumulative and last compilation times (in seconds)
+          and the size of the last css, in bytes
+        - ``checks``: the number of checks done by the ``before_request``
+          hook, their cumulative time and the 50th, 90th and 99th percentiles
+          of their duration (over the last 1000 checks)
+        - ``cache``: the hits, misses and hit rate of the compile cache
+        - ``metrics``: per css file, the :func:`css_metrics` of its last
+          version
+        - ``memory``: the number of entries, size, hits, misses and
+          evictions of the css kept in memory (``css``) and of the imported
+          sources kept by the compiler (``sources``)
+        '''
+        with self.stats_lock:
+            durations = sorted(self.check_durations)
+            hits, misses = self.cache_hits, self.cache_misses
+            checks = {'count': self.check_count,
+                      'total_time': self.check_total_time}
+            compilations = dict((asset, dict(stats)) for asset, stats
+                                in self.compile_stats.items())
+            metrics = dict((name, dict(values)) for name, values
+                           in self.metrics.items())
+        for percentile in (50, 90, 99):
+            checks['p%d' % percentile] = durations[
+                min(len(durations) - 1,
+                    int(len(durations) * percentile / 100.0))] \
+                if durations else None
+        return {
+            'compilations': compilations,
+            'checks': checks,
+            'cache': {'hits': hits, 'misses': misses,
+                      'hit_rate': float(hits) / (hits + misses)
+                                  if hits + misses else None},
+            'metrics': metrics,
+            'memory': {
+                'css': self.memory.stats(),
+                'sources': self.import_cache.sources.stats()
+                           if self._compiler is not None else None,
+            },
+        }
+
+    def read_output(self, dest_path):
+        if self.in_memory:
+            return self.memory[dest_path][0].decode('utf-8')
+        with open(self.output_path(dest_path), 'rb') as css_file:
+            return css_file.read().decode('utf-8')
+
+    def output_mtime(self, dest_path):
+        if self.in_memory:
+            return None
+        try:
+            return op.getmtime(self.output_path(dest_path))
+        except OSError:
+            return None
+
+    def asset_lock(self, asset, dest_path):
+        '''
+        Returns the lock ensuring an asset is compiled by a single thread and
+        by a single process at a time. It is provided by the cache backend,
+        if any, and is a file lock in :meth:`lock_dir` otherwise. Css kept in
+        memory has no destination file, so the lock is named after the asset.
+        '''
+        with self.locks_lock:
+            if asset not in self.locks:
+                name = self.lock_name(asset, dest_path)
+                self.locks[asset] = self.cache.lock(name) \
+                    if self.cache is not None \
+                    else AssetLock(op.join(self.lock_dir(),
+                                           '%s.lock' % name), private=True)
+            return self.locks[asset]
+
+    def lock_name(self, asset, dest_path):
+        key = asset if self.in_memory else op.realpath(dest_path)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def last_compilation(self, asset, dest_path):
+        '''
+        Returns the files imported by the last compilation of ``asset`` by
+        any process, the missing files which would have been imported
+        instead, the :meth:`input_key` of the inputs and the sha1 of the
+        resulting css, or None. They are kept in the lock file of the
+        asset, so its lock must be held.
+        '''
+        lock = self.asset_lock(asset, dest_path)
+        data = lock.read() if isinstance(lock, AssetLock) else None
+        try:
+            imported, shadows, key, digest = json.loads(data.decode('utf-8'))
+        except (AttributeError, TypeError, ValueError):
+            return None
+        return imported, shadows, key, digest
+
+    def record_compilation(self, asset, dest_path, css, imported):
+        lock = self.asset_lock(asset, dest_path)
+        key = self.input_key(asset, imported)
+        if not isinstance(lock, AssetLock) or key is None:
+            return
+        lock.write(json.dumps([
+            sorted(imported), self.shadows.get(asset, []), key,
+            hashlib.sha1(css.encode('utf-8')).hexdigest(),
+        ]).encode('utf-8'))
+
+    def compiled_elsewhere(self, asset, dest_path):
+        '''
+        Checks whether the output of ``asset`` is up to date thanks to a
+        compilation by another process, which is then taken into account.
+        The modification time of the output cannot tell, as identical css is
+        not rewritten, so the content of the inputs and of the output are
+        compared to the ones of the last compilation. The lock of the asset
+        must be held.
+
+        With a cache, the css of the other process is found in the cache
+        instead.
+        '''
+        if self.in_memory or self.cache is not None:
+            return False
+        last = self.last_compilation(asset, dest_path)
+        if last is None:
+            return False
+        imported, shadows, key, digest = last
+        checked = time.time()
+        if any(op.exists(path) for path in shadows) \
+                or self.input_key(asset, imported) != key:
+            return False
+        if self.fingerprint:
+            self.manifest = self.load_manifest()
+        try:
+            css = self.read_output(dest_path)
+        except (IOError, OSError):
+            return False
+        if hashlib.sha1(css.encode('utf-8')).hexdigest() != digest:
+            return False
+        with self.state_lock:
+            self.record_dependencies(asset, imported)
+            self.compiled[asset] = max(checked, self.compiled.get(asset, -1))
+        self.failures.pop(asset, None)
+        return True
+
+    def lock_dir(self):
+        '''
+        Returns the directory of the lock files when there is no cache: a
+        directory of the temporary directory private to the current user and
+        to the application.
+        '''
+        key = '%s:%s' % (getattr(os, 'getuid', lambda: '')(),
+                         op.realpath(self.app.root_path))
+        return op.join(tempfile.gettempdir(), 'flask-scss-locks-%s' % (
+            hashlib.sha1(key.encode('utf-8')).hexdigest()[:16],))
+
+    def compile_css(self, asset):
+        '''
+        Returns the css of ``asset`` and the files it imports, from the cache
+        if its inputs did not change since it was stored.
+        '''
+        cached = self.load_cached(asset)
+        if cached is not None:
+            return cached
+        started = time.time()
+        css, imported, self.shadows[asset] = _compile_asset(self.compiler,
+                                                            asset)
+        self.store_cached(asset, css, imported, started)
+        return css, imported
+
+    def input_key(self, asset, imported):
+        '''
+        Hashes the content of ``asset`` and of all the files it imports,
+        along with the compiler options. Returns None if one of them cannot
+        be read.
+        '''
+        digest = hashlib.sha1(
+            repr(sorted(self.compiler_options.items())).encode('utf-8'))
+        try:
+            for path in [asset] + sorted(imported):
+                if path != asset:
+                    digest.update(path.encode('utf-8'))
+                with open(path, 'rb') as file_in:
+                    digest.update(hashlib.sha1(file_in.read()).digest())
+        except (IOError, OSError):
+            return None
+        return digest.hexdigest()
+
+    def imports_key(self, asset):
+        return 'imports-' + hashlib.sha1(
+            op.realpath(asset).encode('utf-8')).hexdigest()
+
+    def cached_imports(self, asset):
+        '''
+        Returns the files imported by ``asset`` when it was last compiled by
+        any user of the cache, or None.
+        '''
+        cached = self.cached_inputs(asset)
+        return cached[0] if cached is not None else None
+
+    def cached_inputs(self, asset):
+        '''
+        Returns the files imported by ``asset`` when it was last compiled by
+        any user of the cache, and the missing files which would have been
+        imported instead if they existed, or None.
+        '''
+        if self.cache is None:
+            return None
+        inputs = self.cache.get(self.imports_key(asset))
+        if inputs is None:
+            return None
+        inputs = json.loads(inputs.decode('utf-8'))
+        if not isinstance(inputs, dict):
+            return None
+        return inputs['imported'], inputs['shadows']
+
+    def load_cached(self, asset):
+        if self.cache is None:
+            return None
+        inputs = self.cached_inputs(asset)
+        css = None
+        # A file created since the compilation may shadow an import
+        if inputs is not None \
+                and not any(op.exists(path) for path in inputs[1]):
+            key = self.input_key(asset, inputs[0])
+            css = self.cache.get('css-' + key) if key else None
+        with self.stats_lock:
+            if css is None:
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+        if css is None:
+            return None
+        self.shadows[asset] = inputs[1]
+        return css.decode('utf-8'), inputs[0]
+
+    def store_cached(self, asset, css, imported, started):
+        if self.cache is None:
+            return
+        # A file modified during the compilation may not match the css
+        try:
+            if any(op.getmtime(path) >= started
+                   for path in [asset] + list(imported)):
+                return
+        except OSError:
+            return
+        key = self.input_key(asset, imported)
+        if key is None:
+            return
+        self.cache.set('css-' + key, css.encode('utf-8'))
+        self.cache.set(self.imports_key(asset), json.dumps({
+            'imported': sorted(imported),
+            'shadows': self.shadows.get(asset, []),
+        }).encode('utf-8'))
+
+    def write_scss(self, asset, dest_path, css, imported, started=None):
+        '''
+        Writes the css of ``asset`` to its destination. The file is left
+        untouched (along with its modification time) if it already holds the
+        same css, so ``started``, the time at which the compilation started,
+        is recorded to know that the asset is up to date.
+        '''
         self.app.logger.info("[flask-pyscss] refreshing %s" % (dest_path,))
+        with self.state_lock:
+            self.record_dependencies(asset, imported)
+            self.compiled[asset] = started or time.time()
+        self.failures.pop(asset, None)
+        self.write_output(dest_path, css.encode('utf-8'))
+        if not self.in_memory and self.cache is None:
+            self.record_compilation(asset, dest_path, css, imported)
+        return css
+
+    def write_output(self, dest_path, data):
+        '''
+        Writes the bytes ``data`` to ``dest_path``: in memory, or to a file
+        (fingerprinted and precompressed according to the configuration).
+        '''
+        if self.in_memory:
+            self.memory[dest_path] = data, hashlib.sha1(data).hexdigest()
+            return
         if not os.path.exists(op.dirname(dest_path)):
             os.makedirs(op.dirname(dest_path))
-        with codecs.open(dest_path, 'w', 'utf-8') as file_out:
-            with open(asset) as file_in:
-                file_out.write(self.compiler.compile_string(file_in.read()))
+        output = dest_path
+        if self.fingerprint:
+            output = '%s.%s.css' % (dest_path[:-len('.css')],
+                                    hashlib.sha1(data).hexdigest()[:10])
+        written = _write_if_changed(output, data)
+        if self.precompress and (written or not op.exists(output + '.gz')):
+            self.write_compressed(output, data)
+        if self.fingerprint:
+            # The previous version is kept for the pages still linking to it
+            # (see prune_fingerprinted)
+            self.save_manifest({
+                self.logical_name(dest_path): self.logical_name(output)})
+
+    def write_compressed(self, output, data):
+        '''
+        Writes gzip (and brotli, when the ``brotli`` module is available)
+        variants of ``output`` next to it, at maximum compression.
+        '''
+        _write_if_changed(output + '.gz', _gzip(data))
+        if brotli is not None:
+            _write_if_changed(output + '.br',
+                              brotli.compress(data, quality=11))
+
+    def remove_compressed(self, output):
+        for path in (output + '.gz', output + '.br'):
+            if op.exists(path):
+                os.remove(path)
+
+    def logical_name(self, dest_path):
+        '''
+        Returns the path of ``dest_path`` relative to the static directory,
+        with ``/`` as separator (e.g. ``foo/bar.css``).
+        '''
+        return op.relpath(dest_path, self.static_dir).replace(os.sep, '/')
+
+    def output_path(self, dest_path):
+        '''
+        Returns the file actually holding the css of ``dest_path``, which is
+        the fingerprinted file listed in the manifest if ``SCSS_FINGERPRINT``
+        is set.
+        '''
+        if not self.fingerprint:
+            return dest_path
+        name = self.manifest.get(self.logical_name(dest_path))
+        if name is None:
+            return dest_path
+        return op.join(self.static_dir, *name.split('/'))
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path) as manifest:
+                return json.load(manifest)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_manifest(self, updates):
+        '''
+        Adds the ``updates`` to the manifest, merged under a lock with the
+        entries written by the other processes since it was read.
+        '''
+        with self.asset_lock(self.manifest_path, self.manifest_path):
+            manifest = self.load_manifest()
+            manifest.update(updates)
+            _write_if_changed(self.manifest_path, json.dumps(
+                manifest, indent=2, sort_keys=True).encode('utf-8'))
+            self.manifest = manifest
+
+    def prune_fingerprinted(self):
+        '''
+        Removes the previous versions of the fingerprinted files, i.e. the
+        ``foo.<hash>.css`` files (and their compressed variants) that are
+        not listed in the manifest. This is done by :meth:`build_all`, as
+        pages cached by browsers, proxies or an application server not yet
+        restarted may still link to them.
+        '''
+        with self.asset_lock(self.manifest_path, self.manifest_path):
+            manifest = self.load_manifest()
+        current = set(manifest.values())
+        for name in manifest:
+            name = PurePosixPath(name)
+            pattern = re.compile(r'^(%s\.[0-9a-f]{10}\.css)(\.gz|\.br)?$'
+                                 % re.escape(name.stem))
+            folder = op.join(self.static_dir, *name.parent.parts)
+            try:
+                filenames = os.listdir(folder)
+            except OSError:
+                continue
+            for filename in filenames:
+                match = pattern.match(filename)
+                if match is not None and str(
+                        name.parent / match.group(1)) not in current:
+                    os.remove(op.join(folder, filename))
+
+    def scss_url(self, filename, **kwargs):
+        '''
+        Returns the url of the css file ``filename`` (relative to the static
+        directory, e.g. ``foo/bar.css``), resolved through the manifest when
+        ``SCSS_FINGERPRINT`` is set. It is available in templates as
+        ``scss_url``.
+
+        In lazy mode, the fingerprint depends on the css, so the asset is
+        checked (and compiled if it is stale) first.
+        '''
+        if self.in_memory:
+            return url_for('scss', filename=filename, **kwargs)
+        if self.fingerprint:
+            if self.lazy_hooked:
+                self.refresh_requested(filename)
+            filename = self.manifest.get(filename, filename)
+        static_folder = op.join(self.app.root_path, self.app.static_folder)
+        prefix = op.relpath(self.static_dir, static_folder) \
+                 if self.static_dir else os.curdir
+        if prefix != os.curdir:
+            filename = '%s/%s' % (prefix.replace(os.sep, '/'), filename)
+        return url_for('static', filename=filename, **kwargs)
+
+    def serve_css(self, filename):
+        '''
+        Serves the css compiled in memory when ``SCSS_IN_MEMORY`` is set. An
+        asset is compiled on its first request (or when it is stale, in lazy
+        mode), and conditional requests are
+        answered with a 304 when its ETag did not change.
+        '''
+        if filename in self.bundles:
+            if self.lazy or filename not in self.memory:
+                self.refresh_bundle(filename)
+        elif filename not in self.memory \
+                or (self.lazy and self.is_stale(self.find_asset(filename),
+                                                filename)):
+            asset = self.find_asset(filename)
+            if asset is None:
+                abort(404)
+            self.assets.setdefault(asset, filename)
+            self.refresh({asset: filename})
+        data, etag = self.memory[filename]
+        response = self.app.response_class(data, mimetype='text/css')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = self.cache_control
+        return response.make_conditional(request)
@@ -15,6 +15,10 @@ from flask import Flask
 import flask_scss
 import time
 import pathlib
+import json
+import gzip
+import threading
+import hashlib
 
 SCSS_CONTENT = "a { color: red; text-decoration: none; }"
 SCSS_UNICODE_CONTENT = "a { content: \"ビール ሳድስ ๛\";}"
@@ -314,6 +318,1059 @@ class ScssTest(unittest.TestCase):
             css_newer_content = file_in.read()
         self.assertNotEqual(css_newer_content, "nothing")
 
+    def test_partial_change_only_refreshes_assets_importing_it(self):
+        self.set_layout()
+        importing_css = self.create_static_file('foo.css')
+        other_css = self.create_static_file('bar.css')
+        importing_scss = self.create_asset_file(
+            'foo.scss', content=SCSS_CONTENT_WITH_PARTIAL)
+        other_scss = self.create_asset_file('bar.scss')
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        for path in (importing_scss, other_scss, partial):
+            os.utime(path, (time.time() - 30, time.time() - 30))
+        for path in (importing_css, other_css):
+            os.utime(path, (time.time() - 40, time.time() - 40))
+
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        self.assertEqual(scss_inst.dependents[op.realpath(partial)],
+                         set([importing_scss]))
+
+        os.utime(partial, (time.time() - 5, time.time() - 5))
+        with patch.object(scss_inst, 'compile_scss') as mock_compile:
+            scss_inst.update_scss()
+        mock_compile.assert_called_once_with(importing_scss, importing_css)
+
+    def test_watcher_reports_modified_files(self):
+        self.set_layout()
+        scss_path = self.create_asset_file('foo.scss')
+        with patch.object(flask_scss, 'Observer', None):
+            watcher = flask_scss.Watcher([self.asset_dir], interval=0.01)
+            watcher.start()
+            try:
+                os.utime(scss_path, (time.time() + 5, time.time() + 5))
+                new_path = self.create_asset_file('bar.scss')
+                time.sleep(0.1)
+            finally:
+                watcher.stop()
+        self.assertEqual(watcher.drain(), set([scss_path, new_path]))
+        self.assertEqual(watcher.drain(), set())
+
+    def test_update_scss_in_watch_mode_only_compiles_reported_files(self):
+        self.set_layout()
+        foo_scss = self.create_asset_file('foo.scss')
+        self.create_asset_file('bar.scss')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.watcher = Mock()
+        scss_inst.update_scss()
+        scss_inst.watcher.drain.return_value = set([foo_scss])
+        with patch.object(scss_inst, 'compile_scss') as mock_compile:
+            with patch.object(scss_inst, 'discover_scss') as mock_discover:
+                scss_inst.update_scss()
+        self.assertFalse(mock_discover.called)
+        mock_compile.assert_called_once_with(
+            foo_scss, op.join(self.static_dir, 'foo.css'))
+
+    def test_update_scss_in_watch_mode_forgets_deleted_assets(self):
+        self.set_layout()
+        foo_scss = self.create_asset_file('foo.scss')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.watcher = Mock()
+        scss_inst.update_scss()
+        os.remove(foo_scss)
+        scss_inst.watcher.drain.return_value = set([foo_scss])
+        scss_inst.update_scss()
+        self.assertNotIn(foo_scss, scss_inst.assets)
+
+    def test_update_scss_compiles_stale_assets_in_a_process_pool(self):
+        self.set_layout()
+        self.app.config['SCSS_WORKERS'] = 2
+        self.create_asset_file('foo.scss')
+        self.create_asset_file('bar/baz.scss', content=SCSS_CONTENT_WITH_PARTIAL)
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        scss_inst = flask_scss.Scss(self.app)
+        try:
+            scss_inst.update_scss()
+        finally:
+            scss_inst.pool.terminate()
+        with open(op.join(self.static_dir, 'bar', 'baz.css')) as css_file:
+            self.assertIn(".test", css_file.read())
+        self.assertTrue(op.exists(op.join(self.static_dir, 'foo.css')))
+        self.assertIn(op.join(self.asset_dir, 'bar', 'baz.scss'),
+                      scss_inst.dependents[op.realpath(partial)])
+
+    def test_compile_many_releases_the_locks_when_the_dispatch_fails(self):
+        self.set_layout()
+        assets = {}
+        for name in ('foo', 'bar'):
+            assets[self.create_asset_file('%s.scss' % name)] = \
+                op.join(self.static_dir, '%s.css' % name)
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.pool = Mock()
+        scss_inst.pool_size = 2
+        with patch.object(scss_inst, 'load_cached',
+                          side_effect=[None, IOError('cache is down')]):
+            self.assertRaises(IOError, scss_inst.compile_many, assets, 2)
+        for asset, dest_path in assets.items():
+            lock = scss_inst.asset_lock(asset, dest_path)
+            self.assertTrue(lock.acquire(blocking=False))
+            lock.release()
+
+    def test_compile_scss_reuses_the_disk_cache_when_inputs_are_unchanged(self):
+        self.set_layout()
+        self.app.config['SCSS_CACHE_DIR'] = op.join(self.test_data, 'cache')
+        scss_path = self.create_asset_file('foo.scss',
+                                           content=SCSS_CONTENT_WITH_PARTIAL)
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        for path in (scss_path, partial):
+            os.utime(path, (time.time() - 10, time.time() - 10))
+        css_path = op.join(self.static_dir, 'foo.css')
+        flask_scss.Scss(self.app).compile_scss(scss_path, css_path)
+        os.remove(css_path)
+
+        scss_inst = flask_scss.Scss(self.app)
+        with patch.object(flask_scss, '_compile_asset') as mock_compile:
+            scss_inst.compile_scss(scss_path, css_path)
+        self.assertFalse(mock_compile.called)
+        with open(css_path) as css_file:
+            self.assertIn(".test", css_file.read())
+        self.assertIn(scss_path, scss_inst.dependents[op.realpath(partial)])
+
+    def test_compile_scss_misses_the_disk_cache_when_an_import_is_shadowed(self):
+        # With a cache, and with the last compilation kept in the lock file
+        for cache_dir in (op.join(self.test_data, 'cache'), None):
+            self.set_layout()
+            vendor = op.join(self.test_data, 'vendor')
+            os.makedirs(vendor)
+            with open(op.join(vendor, '_x.scss'), 'w') as vendor_file:
+                vendor_file.write(".vendor{color: blue;}")
+            self.app.config['SCSS_LOAD_PATHS'] = [vendor]
+            self.app.config['SCSS_CACHE_DIR'] = cache_dir
+            scss_path = self.create_asset_file('foo.scss',
+                                               content='@import "x";')
+            css_path = op.join(self.static_dir, 'foo.css')
+            flask_scss.Scss(self.app).compile_scss(scss_path, css_path)
+
+            self.create_asset_file('_x.scss', content=TEST_PARTIAL)
+            scss_inst = flask_scss.Scss(self.app)
+            self.assertIn('.test', scss_inst.compile_scss(scss_path,
+                                                          css_path))
+            self.assertEqual(scss_inst.stats()['cache']['hits'], 0)
+            shutil.rmtree(self.test_data)
+
+    def test_compile_scss_misses_the_disk_cache_when_a_partial_changes(self):
+        self.set_layout()
+        self.app.config['SCSS_CACHE_DIR'] = op.join(self.test_data, 'cache')
+        scss_path = self.create_asset_file('foo.scss',
+                                           content=SCSS_CONTENT_WITH_PARTIAL)
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        for path in (scss_path, partial):
+            os.utime(path, (time.time() - 10, time.time() - 10))
+        css_path = op.join(self.static_dir, 'foo.css')
+        flask_scss.Scss(self.app).compile_scss(scss_path, css_path)
+        self.create_asset_file('_test.scss', content=".other{color: white;}")
+
+        flask_scss.Scss(self.app).compile_scss(scss_path, css_path)
+        with open(css_path) as css_file:
+            self.assertIn(".other", css_file.read())
+
+    def test_build_all_compiles_every_asset_and_reports_errors(self):
+        self.set_layout()
+        self.create_asset_file('foo.scss')
+        self.create_asset_file('bar.scss', content="a { color: ; }")
+        css_path = self.create_static_file('foo.css')
+        os.utime(css_path, (time.time() + 10, time.time() + 10))
+        scss_inst = flask_scss.Scss(self.app)
+        results = dict((op.basename(result.asset), result)
+                       for result in scss_inst.build_all())
+        self.assertIsNone(results['foo.scss'].error)
+        self.assertGreater(results['foo.scss'].size, 0)
+        self.assertIsNotNone(results['bar.scss'].error)
+        with open(css_path) as css_file:
+            self.assertNotEqual(css_file.read(), "nothing")
+
+    def test_build_command_exits_with_an_error_on_failures(self):
+        self.set_layout()
+        self.create_asset_file('foo.scss')
+        flask_app = Flask('__main__', root_path=self.test_data)
+        flask_scss.Scss(flask_app)
+        runner = flask_app.test_cli_runner()
+        result = runner.invoke(args=['scss', 'build'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn(op.join(self.static_dir, 'foo.css'), result.output)
+        self.create_asset_file('bar.scss', content="a { color: ; }")
+        result = runner.invoke(args=['scss', 'build', '--workers', '2'])
+        self.assertEqual(result.exit_code, 1)
+
+    def test_fingerprinted_outputs_are_listed_in_the_manifest(self):
+        self.set_layout()
+        self.app.config['SCSS_FINGERPRINT'] = True
+        self.create_asset_file('bar/baz.scss')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        hashed = scss_inst.manifest['bar/baz.css']
+        self.assertRegex(hashed, r'^bar/baz\.[0-9a-f]{10}\.css$')
+        self.assertTrue(op.exists(op.join(self.static_dir, hashed)))
+        self.assertFalse(op.exists(op.join(self.static_dir, 'bar', 'baz.css')))
+        with open(op.join(self.static_dir, 'scss-manifest.json')) as manifest:
+            self.assertEqual(json.load(manifest), {'bar/baz.css': hashed})
+        with patch.object(scss_inst, 'compile_scss') as mock_compile:
+            scss_inst.update_scss()
+        self.assertFalse(mock_compile.called)
+
+    def test_fingerprinted_outputs_replace_the_previous_version(self):
+        self.set_layout()
+        self.app.config['SCSS_FINGERPRINT'] = True
+        self.app.config['SCSS_PRECOMPRESS'] = True
+        scss_path = self.create_asset_file('foo.scss')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        previous = scss_inst.manifest['foo.css']
+        self.create_asset_file('foo.scss', content=TEST_PARTIAL)
+        os.utime(scss_path, (time.time() + 5, time.time() + 5))
+        scss_inst.update_scss()
+        current = scss_inst.manifest['foo.css']
+        self.assertNotEqual(current, previous)
+        # Pages linking to the previous version keep working until a build
+        self.assertTrue(op.exists(op.join(self.static_dir, previous)))
+        scss_inst.build_all()
+        self.assertEqual(sorted(os.listdir(self.static_dir)), sorted([
+            current, current + '.gz', 'scss-manifest.json']))
+
+    def test_fingerprinted_outputs_are_merged_in_the_manifest(self):
+        self.set_layout()
+        self.app.config['SCSS_FINGERPRINT'] = True
+        foo_path = self.create_asset_file('foo.scss')
+        bar_path = self.create_asset_file('bar.scss')
+        first = flask_scss.Scss(self.app)
+        second = flask_scss.Scss(self.app)
+        first.compile_scss(foo_path, op.join(self.static_dir, 'foo.css'))
+        second.compile_scss(bar_path, op.join(self.static_dir, 'bar.css'))
+        first.compile_scss(foo_path, op.join(self.static_dir, 'foo.css'))
+        with open(op.join(self.static_dir, 'scss-manifest.json')) as manifest:
+            self.assertEqual(sorted(json.load(manifest)),
+                             ['bar.css', 'foo.css'])
+        self.assertIn('bar.css', first.manifest)
+
+    def test_scss_url_resolves_through_the_manifest(self):
+        self.set_layout()
+        self.create_asset_file('foo.scss')
+        flask_app = Flask('__main__', root_path=self.test_data)
+        flask_app.config['SCSS_FINGERPRINT'] = True
+        flask_scss.Scss(flask_app).build_all()
+        flask_scss.Scss(flask_app)
+        with flask_app.test_request_context():
+            url = flask_app.jinja_env.from_string(
+                "{{ scss_url('foo.css') }}").render()
+        self.assertRegex(url, r'^/static/foo\.[0-9a-f]{10}\.css$')
+
+    def test_precompressed_variants_are_written_and_removed(self):
+        self.set_layout()
+        self.app.config['SCSS_PRECOMPRESS'] = True
+        scss_path = self.create_asset_file('foo.scss')
+        css_path = op.join(self.static_dir, 'foo.css')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        with open(css_path, 'rb') as css_file:
+            css_content = css_file.read()
+        with gzip.open(css_path + '.gz') as gz_file:
+            self.assertEqual(gz_file.read(), css_content)
+
+        os.remove(scss_path)
+        scss_inst.update_scss()
+        self.assertNotIn(scss_path, scss_inst.assets)
+        self.assertFalse(op.exists(css_path + '.gz'))
+
+    def test_compile_scss_does_not_rewrite_identical_css(self):
+        self.set_layout()
+        scss_path = self.create_asset_file('foo.scss')
+        css_path = op.join(self.static_dir, 'foo.css')
+        flask_scss.Scss(self.app).compile_scss(scss_path, css_path)
+        os.utime(css_path, (time.time() - 10, time.time() - 10))
+        os.utime(scss_path, (time.time() - 5, time.time() - 5))
+        css_mtime = op.getmtime(css_path)
+
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        self.assertEqual(op.getmtime(css_path), css_mtime)
+        self.assertEqual(os.listdir(self.static_dir), ['foo.css'])
+        with patch.object(scss_inst, 'compile_scss') as mock_compile:
+            scss_inst.update_scss()
+        self.assertFalse(mock_compile.called)
+
+    def test_update_scss_runs_at_most_once_per_check_interval(self):
+        self.set_layout()
+        self.app.config['SCSS_CHECK_INTERVAL'] = 60
+        scss_inst = flask_scss.Scss(self.app)
+        with patch.object(scss_inst, 'check_scss') as mock_check:
+            scss_inst.update_scss()
+            scss_inst.update_scss()
+        self.assertEqual(mock_check.call_count, 1)
+        self.assertIsNotNone(scss_inst.last_check_duration)
+
+    def test_update_scss_ignores_skipped_endpoints_and_non_html_requests(self):
+        self.set_layout()
+        flask_app = Flask('__main__', root_path=self.test_data)
+        flask_app.config['SCSS_SKIP_ENDPOINTS'] = ['static']
+        flask_app.config['SCSS_CHECK_HTML_ONLY'] = True
+        scss_inst = flask_scss.Scss(flask_app)
+        with patch.object(scss_inst, 'check_scss') as mock_check:
+            with flask_app.test_request_context('/static/foo.css'):
+                scss_inst.update_scss()
+            for accept in ('application/json', 'text/css,*/*;q=0.1', '*/*',
+                           'image/webp,*/*', 'text/css,text/html;q=0.5'):
+                with flask_app.test_request_context(
+                        '/', headers={'Accept': accept}):
+                    scss_inst.update_scss()
+            self.assertFalse(mock_check.called)
+            for accept in ('text/html', 'text/html,application/xhtml+xml,'
+                           'application/xml;q=0.9,*/*;q=0.8'):
+                with flask_app.test_request_context(
+                        '/', headers={'Accept': accept}):
+                    scss_inst.update_scss()
+        self.assertEqual(mock_check.call_count, 2)
+
+    def test_concurrent_compilations_of_an_asset_are_done_once(self):
+        self.set_layout()
+        scss_path = self.create_asset_file('foo.scss')
+        css_path = op.join(self.static_dir, 'foo.css')
+        scss_inst = flask_scss.Scss(self.app)
+        compile_asset = flask_scss._compile_asset
+
+        def slow_compile(compiler, asset):
+            time.sleep(0.2)
+            return compile_asset(compiler, asset)
+
+        with patch.object(flask_scss, '_compile_asset',
+                          side_effect=slow_compile) as mock_compile:
+            threads = [threading.Thread(target=scss_inst.compile_scss,
+                                        args=(scss_path, css_path))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(mock_compile.call_count, 1)
+        self.assertTrue(op.exists(css_path))
+
+    def test_processes_reuse_a_compilation_of_unchanged_css(self):
+        for fingerprint in (False, True):
+            self.set_layout()
+            self.app.config['SCSS_FINGERPRINT'] = fingerprint
+            scss_path = self.create_asset_file('foo.scss')
+            os.utime(scss_path, (time.time() - 10, time.time() - 10))
+            first = flask_scss.Scss(self.app)
+            second = flask_scss.Scss(self.app)
+            with patch.object(flask_scss, '_compile_asset',
+                              wraps=flask_scss._compile_asset) as mock_compile:
+                first.update_scss()
+                second.update_scss()
+                self.assertEqual(mock_compile.call_count, 1)
+
+                # Touched without changes: the css is identical, so its file
+                # is not rewritten, and is not compiled again
+                os.utime(scss_path, None)
+                first.update_scss()
+                second.update_scss()
+                second.update_scss()
+                self.assertEqual(mock_compile.call_count, 1)
+
+                self.create_asset_file('foo.scss', content=TEST_PARTIAL)
+                os.utime(scss_path, (time.time() + 5, time.time() + 5))
+                first.update_scss()
+                second.update_scss()
+                self.assertEqual(mock_compile.call_count, 2)
+            self.assertIn('.test', second.read_output(
+                second.assets[scss_path]))
+
+            # Nor is it dispatched to the process pool
+            os.utime(scss_path, None)
+            bar_path = self.create_asset_file('bar.scss')
+            second.pool = Mock()
+            second.pool_size = 2
+            second.compile_many({
+                scss_path: second.assets[scss_path],
+                bar_path: op.join(self.static_dir, 'bar.css'),
+            }, workers=2, raise_errors=False)
+            self.assertEqual(
+                [args[0][1][1] for args in
+                 second.pool.apply_async.call_args_list], [bar_path])
+            shutil.rmtree(self.test_data)
+
+    def test_in_memory_css_is_served_with_an_etag(self):
+        asset_dir = op.join(self.test_data, 'assets')
+        os.makedirs(op.join(asset_dir, 'bar'))
+        with open(op.join(asset_dir, 'bar', 'baz.scss'), 'w') as scss_file:
+            scss_file.write(SCSS_CONTENT)
+        flask_app = Flask('__main__', root_path=self.test_data)
+        flask_app.config['SCSS_IN_MEMORY'] = True
+        flask_app.config['SCSS_CACHE_CONTROL'] = 'max-age=60'
+        scss_inst = flask_scss.Scss(flask_app)
+        client = flask_app.test_client()
+
+        response = client.get('/scss/bar/baz.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn(b'text-decoration', response.data)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=60')
+        self.assertFalse(op.exists(op.join(self.test_data, 'static')))
+
+        etag = response.headers['ETag']
+        response = client.get('/scss/bar/baz.css',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(client.get('/scss/bar/nope.css').status_code, 404)
+        self.assertEqual(client.get('/scss/../x.css').status_code, 404)
+        with flask_app.test_request_context():
+            self.assertEqual(scss_inst.scss_url('bar/baz.css'),
+                             '/scss/bar/baz.css')
+
+    def test_update_scss_refreshes_in_memory_css(self):
+        self.set_layout()
+        self.app.config['SCSS_IN_MEMORY'] = True
+        scss_path = self.create_asset_file('foo.scss')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        self.assertIn(b'text-decoration', scss_inst.memory['foo.css'][0])
+        self.assertFalse(op.exists(op.join(self.static_dir, 'foo.css')))
+        self.create_asset_file('foo.scss', content=TEST_PARTIAL)
+        os.utime(scss_path, (time.time() + 5, time.time() + 5))
+        scss_inst.update_scss()
+        self.assertIn(b'.test', scss_inst.memory['foo.css'][0])
+
+    def test_in_memory_css_ignores_files_of_the_working_directory(self):
+        self.set_layout()
+        self.app.config['SCSS_IN_MEMORY'] = True
+        scss_path = self.create_asset_file('foo.scss')
+        os.utime(scss_path, (time.time() - 10, time.time() - 10))
+        scss_inst = flask_scss.Scss(self.app)
+        cwd = os.getcwd()
+        os.chdir(self.test_data)
+        try:
+            # A file named like the css in the working directory, newer than
+            # the asset, must not make it look up to date.
+            with open('foo.css', 'w') as css_file:
+                css_file.write('stale')
+            self.assertTrue(scss_inst.is_stale(scss_path, 'foo.css'))
+            self.assertIsNone(scss_inst.output_mtime('foo.css'))
+            scss_inst.update_scss()
+            self.assertFalse(scss_inst.is_stale(scss_path, 'foo.css'))
+            self.assertIn(b'text-decoration', scss_inst.memory['foo.css'][0])
+        finally:
+            os.chdir(cwd)
+        lock = scss_inst.asset_lock(scss_path, 'foo.css')
+        self.assertIn(hashlib.sha1(scss_path.encode('utf-8')).hexdigest(),
+                      lock.path)
+
+    def test_lazy_mode_only_compiles_the_requested_asset(self):
+        self.set_layout()
+        self.create_asset_file('foo.scss', content=SCSS_CONTENT_WITH_PARTIAL)
+        self.create_asset_file('bar.scss')
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        flask_app = Flask('__main__', root_path=self.test_data)
+        flask_app.config['SCSS_LAZY'] = True
+        flask_app.testing = True
+        flask_scss.Scss(flask_app)
+        client = flask_app.test_client()
+
+        response = client.get('/static/foo.css')
+        self.assertIn(b'.test', response.data)
+        response.close()
+        self.assertFalse(op.exists(op.join(self.static_dir, 'bar.css')))
+
+        self.create_asset_file('_test.scss', content=".other{color: white;}")
+        os.utime(partial, (time.time() + 5, time.time() + 5))
+        response = client.get('/static/foo.css')
+        self.assertIn(b'.other', response.data)
+        response.close()
+
+    def test_lazy_mode_resolves_fingerprinted_names(self):
+        self.set_layout()
+        scss_path = self.create_asset_file('foo.scss')
+        flask_app = Flask('__main__', root_path=self.test_data)
+        flask_app.config['SCSS_LAZY'] = True
+        flask_app.config['SCSS_FINGERPRINT'] = True
+        flask_app.testing = True
+        scss_inst = flask_scss.Scss(flask_app)
+        client = flask_app.test_client()
+
+        with flask_app.test_request_context():
+            url = scss_inst.scss_url('foo.css')
+        self.assertRegex(url, r'^/static/foo\.[0-9a-f]{10}\.css$')
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        response = client.get('/static/foo.css')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.headers['Location'].endswith(url))
+
+        self.create_asset_file('foo.scss', content=TEST_PARTIAL)
+        os.utime(scss_path, (time.time() + 5, time.time() + 5))
+        response = client.get(url)
+        self.assertEqual(response.status_code, 302)
+        new_url = response.headers['Location']
+        self.assertFalse(new_url.endswith(url))
+        response = client.get(new_url)
+        self.assertIn(b'.test', response.data)
+        response.close()
+
+    def test_compilations_and_checks_send_signals(self):
+        self.set_layout()
+        scss_path = self.create_asset_file('foo.scss')
+        broken_path = self.create_asset_file('bar.scss',
+                                             content="a { color: ; }")
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        scss_inst = flask_scss.Scss(self.app)
+        signals = [flask_scss.scss_compile_started,
+                   flask_scss.scss_compile_finished,
+                   flask_scss.scss_compile_failed,
+                   flask_scss.scss_check_finished]
+        for signal in signals:
+            signal.connect(receiver, sender=self.app)
+        try:
+            self.assertRaises(Exception, scss_inst.update_scss)
+            scss_inst.compile_scss(scss_path,
+                                   op.join(self.static_dir, 'foo.css'))
+            os.remove(broken_path)
+            scss_inst.update_scss()
+        finally:
+            for signal in signals:
+                signal.disconnect(receiver)
+        failed = [kwargs for kwargs in received if 'error' in kwargs]
+        self.assertEqual(len(failed), 1)
+        finished = [kwargs for kwargs in received if 'size' in kwargs]
+        self.assertEqual(finished[0]['asset'], scss_path)
+        self.assertGreater(finished[0]['size'], 0)
+        checks = [kwargs for kwargs in received if 'compiled' in kwargs]
+        self.assertEqual(checks[0]['assets'], 1)
+
+    def test_cache_hits_of_the_process_pool_send_both_signals(self):
+        self.set_layout()
+        self.app.config['SCSS_CACHE_DIR'] = op.join(self.test_data, 'cache')
+        self.app.config['SCSS_WORKERS'] = 2
+        self.create_asset_file('foo.scss')
+        self.create_asset_file('bar.scss', content=TEST_PARTIAL)
+        flask_scss.Scss(self.app).build_all(workers=1)
+        received = []
+
+        def receiver(signal):
+            return lambda sender, **kwargs: received.append(
+                (signal, kwargs['asset']))
+
+        started = receiver('started')
+        finished = receiver('finished')
+        flask_scss.scss_compile_started.connect(started, sender=self.app)
+        flask_scss.scss_compile_finished.connect(finished, sender=self.app)
+        scss_inst = flask_scss.Scss(self.app)
+        try:
+            scss_inst.build_all()
+        finally:
+            flask_scss.scss_compile_started.disconnect(started)
+            flask_scss.scss_compile_finished.disconnect(finished)
+            scss_inst.close()
+        self.assertEqual(scss_inst.stats()['cache']['hits'], 2)
+        self.assertEqual(
+            sorted(asset for signal, asset in received
+                   if signal == 'started'),
+            sorted(asset for signal, asset in received
+                   if signal == 'finished'))
+        self.assertEqual(len(received), 4)
+
+    def test_stats_reports_compilations_checks_and_cache_hits(self):
+        self.set_layout()
+        self.app.config['SCSS_CACHE_DIR'] = op.join(self.test_data, 'cache')
+        scss_path = self.create_asset_file('foo.scss')
+        os.utime(scss_path, (time.time() - 10, time.time() - 10))
+        css_path = op.join(self.static_dir, 'foo.css')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        scss_inst.update_scss()
+        scss_inst.compile_scss(scss_path, css_path)
+        stats = scss_inst.stats()
+        self.assertEqual(stats['compilations'][scss_path]['count'], 2)
+        self.assertEqual(stats['checks']['count'], 2)
+        self.assertIsNotNone(stats['checks']['p99'])
+        self.assertEqual(stats['cache'],
+                         {'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+
+    def test_partials_are_read_once_for_all_importing_assets(self):
+        self.set_layout()
+        self.create_asset_file('foo.scss', content=SCSS_CONTENT_WITH_PARTIAL)
+        self.create_asset_file('bar/baz.scss',
+                               content=SCSS_CONTENT_WITH_PARTIAL)
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        scss_inst = flask_scss.Scss(self.app)
+        read = flask_scss.SourceFile.read
+        with patch.object(flask_scss.SourceFile, 'read',
+                          side_effect=read) as mock_read:
+            scss_inst.update_scss()
+            self.assertEqual(mock_read.call_count, 1)
+            self.create_asset_file('_test.scss',
+                                   content=".other{color: white;}")
+            os.utime(partial, (time.time() + 5, time.time() + 5))
+            scss_inst.update_scss()
+            self.assertEqual(mock_read.call_count, 2)
+        with open(op.join(self.static_dir, 'bar', 'baz.css')) as css_file:
+            self.assertIn(".other", css_file.read())
+
+    def test_background_mode_serves_the_previous_css_while_compiling(self):
+        self.set_layout()
+        self.app.config['SCSS_BACKGROUND'] = True
+        scss_path = self.create_asset_file('foo.scss')
+        css_path = op.join(self.static_dir, 'foo.css')
+        scss_inst = flask_scss.Scss(self.app)
+        # Assets without css are compiled right away
+        scss_inst.update_scss()
+        self.assertIsNone(scss_inst.background_thread)
+        with open(css_path) as css_file:
+            self.assertIn("text-decoration", css_file.read())
+
+        self.create_asset_file('foo.scss', content=TEST_PARTIAL)
+        os.utime(scss_path, (time.time() + 5, time.time() + 5))
+        release = threading.Event()
+        compile_asset = flask_scss._compile_asset
+
+        def blocked_compile(compiler, asset):
+            release.wait(5)
+            return compile_asset(compiler, asset)
+
+        try:
+            with patch.object(flask_scss, '_compile_asset',
+                              side_effect=blocked_compile) as mock_compile:
+                scss_inst.update_scss()
+                scss_inst.update_scss()
+                with open(css_path) as css_file:
+                    self.assertIn("text-decoration", css_file.read())
+                release.set()
+                scss_inst.queue.join()
+            self.assertEqual(mock_compile.call_count, 1)
+            with open(css_path) as css_file:
+                self.assertIn(".test", css_file.read())
+        finally:
+            release.set()
+            scss_inst.close()
+        self.assertIsNone(scss_inst.background_thread)
+
+    def test_background_thread_survives_unexpected_errors(self):
+        self.set_layout()
+        self.app.config['SCSS_BACKGROUND'] = True
+        scss_path = self.create_asset_file('foo.scss')
+        css_path = op.join(self.static_dir, 'foo.css')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        compile_many = scss_inst.compile_many
+
+        def failing_compile(assets, **kwargs):
+            if assets:
+                raise IOError('cache is down')
+            return compile_many(assets, **kwargs)
+
+        try:
+            with patch.object(scss_inst, 'compile_many',
+                              side_effect=failing_compile):
+                self.create_asset_file('foo.scss', content=TEST_PARTIAL)
+                os.utime(scss_path, (time.time() + 5, time.time() + 5))
+                scss_inst.update_scss()
+                scss_inst.queue.join()
+            self.assertTrue(self.app.logger.exception.called)
+            self.assertTrue(scss_inst.background_thread.is_alive())
+            scss_inst.update_scss()
+            scss_inst.queue.join()
+            with open(css_path) as css_file:
+                self.assertIn(".test", css_file.read())
+        finally:
+            scss_inst.close()
+
+    def test_instances_sharing_a_cache_backend_compile_once(self):
+        self.set_layout()
+        self.create_asset_file('foo.scss', content=SCSS_CONTENT_WITH_PARTIAL)
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        cache = flask_scss.SimpleCache()
+        self.app.config['SCSS_CACHE_BACKEND'] = cache
+        first = flask_scss.Scss(self.app)
+        second = flask_scss.Scss(self.app)
+        self.assertIs(first.asset_lock('a', 'a.css'),
+                      second.asset_lock('a', 'a.css'))
+        with patch.object(flask_scss, '_compile_asset',
+                          wraps=flask_scss._compile_asset) as mock_compile:
+            first.build_all()
+            second.build_all()
+        self.assertEqual(mock_compile.call_count, 1)
+        self.assertEqual(second.stats()['cache']['hits'], 1)
+        self.assertEqual(second.dependencies[op.join(self.asset_dir,
+                                                     'foo.scss')],
+                         set([op.realpath(partial)]))
+
+    def test_file_system_cache_provides_file_locks(self):
+        cache = flask_scss.FileSystemCache(op.join(self.test_data, 'cache'))
+        lock = cache.lock('foo')
+        self.assertTrue(lock.acquire(blocking=False))
+        try:
+            self.assertTrue(op.exists(op.join(self.test_data, 'cache',
+                                              'locks', 'foo.lock')))
+            self.assertFalse(cache.lock('foo').acquire(blocking=False))
+        finally:
+            lock.release()
+
+    def test_bundles_concatenate_their_members(self):
+        self.set_layout()
+        self.app.config['SCSS_BUNDLES'] = {'all.css': ['foo.scss',
+                                                       'bar/baz.scss']}
+        self.create_asset_file('foo.scss', content=SCSS_CONTENT_WITH_PARTIAL)
+        baz_path = self.create_asset_file('bar/baz.scss',
+                                          content=".baz{color: blue;}")
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        bundle_path = op.join(self.static_dir, 'all.css')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        with open(bundle_path) as css_file:
+            css = css_file.read()
+        self.assertLess(css.index('.test'), css.index('.baz'))
+
+        with patch.object(scss_inst, 'build_bundle') as mock_build:
+            scss_inst.update_scss()
+        self.assertFalse(mock_build.called)
+
+        self.create_asset_file('_test.scss', content=".other{color: white;}")
+        os.utime(partial, (time.time() + 5, time.time() + 5))
+        scss_inst.update_scss()
+        with open(bundle_path) as css_file:
+            css = css_file.read()
+        self.assertIn('.other', css)
+        self.assertIn('.baz', css)
+
+        os.remove(bundle_path)
+        results = scss_inst.build_all()
+        self.assertIn(('all.css', bundle_path),
+                      [(result.asset, result.dest_path)
+                       for result in results])
+        self.assertTrue(op.exists(bundle_path))
+        self.assertTrue(op.exists(op.join(self.static_dir, 'bar',
+                                          'baz.css')))
+        self.assertEqual(scss_inst.bundles['all.css'][1], baz_path)
+
+    def test_bundles_are_served_from_memory(self):
+        self.set_layout()
+        self.create_asset_file('foo.scss')
+        self.create_asset_file('bar.scss', content=TEST_PARTIAL)
+        flask_app = Flask('__main__', root_path=self.test_data)
+        flask_app.config['SCSS_IN_MEMORY'] = True
+        scss_inst = flask_scss.Scss(flask_app)
+        scss_inst.register_bundle('site.css', ['foo.scss', 'bar.scss'])
+        response = flask_app.test_client().get('/scss/site.css')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'text-decoration', response.data)
+        self.assertIn(b'.test', response.data)
+
+    def test_failed_compilations_are_not_retried_until_inputs_change(self):
+        self.set_layout()
+        scss_path = self.create_asset_file(
+            'foo.scss', content="@import \"test\";\na { color: ; }")
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        scss_inst = flask_scss.Scss(self.app)
+        with patch.object(flask_scss, '_compile_asset',
+                          wraps=flask_scss._compile_asset) as mock_compile:
+            self.assertRaises(Exception, scss_inst.update_scss)
+            self.assertRaises(flask_scss.CompilationError,
+                              scss_inst.update_scss)
+            self.assertEqual(mock_compile.call_count, 1)
+            self.assertEqual(scss_inst.dependencies[scss_path],
+                             set([op.realpath(partial)]))
+
+            self.create_asset_file('_test.scss',
+                                   content=".other{color: white;}")
+            os.utime(partial, (time.time() + 5, time.time() + 5))
+            self.assertRaises(Exception, scss_inst.update_scss)
+            self.assertEqual(mock_compile.call_count, 2)
+
+            self.create_asset_file('foo.scss',
+                                   content=SCSS_CONTENT_WITH_PARTIAL)
+            scss_inst.update_scss()
+            self.assertEqual(mock_compile.call_count, 3)
+        self.assertEqual(scss_inst.failures, {})
+
+    def test_failed_compilations_are_shown_as_css(self):
+        self.set_layout()
+        self.app.config['SCSS_ERROR_CSS'] = True
+        self.create_asset_file('foo.scss', content="a { color: ; }")
+        scss_inst = flask_scss.Scss(self.app)
+        results = scss_inst.check_scss()
+        self.assertIsNotNone(results[0].error)
+        with open(op.join(self.static_dir, 'foo.css')) as css_file:
+            css = css_file.read()
+        self.assertTrue(css.startswith('body:before { content: "'))
+        self.assertEqual(scss_inst.check_scss(), [])
+
+    def test_warm_up_compiles_stale_assets_in_the_background(self):
+        self.set_layout()
+        self.app.config['SCSS_WARMUP'] = True
+        self.app.testing = False
+        self.app.debug = False
+        self.create_asset_file('foo.scss')
+        self.create_asset_file('bar/baz.scss', content=TEST_PARTIAL)
+        scss_inst = flask_scss.Scss(self.app)
+        self.assertTrue(scss_inst.wait_until_warm(5))
+        self.assertTrue(op.exists(op.join(self.static_dir, 'foo.css')))
+        self.assertTrue(op.exists(op.join(self.static_dir, 'bar',
+                                          'baz.css')))
+        scss_inst.close()
+
+        self.app.config['SCSS_WARMUP'] = False
+        self.assertTrue(flask_scss.Scss(self.app).ready.is_set())
+
+    def test_compiler_is_created_on_first_use(self):
+        self.set_layout()
+        scss_path = self.create_asset_file('foo.scss')
+        with patch.object(flask_scss, '_make_compiler',
+                          wraps=flask_scss._make_compiler) as mock_make:
+            scss_inst = flask_scss.Scss(self.app)
+            self.assertFalse(mock_make.called)
+            scss_inst.compile_scss(scss_path,
+                                   op.join(self.static_dir, 'foo.css'))
+            scss_inst.compile_scss(scss_path,
+                                   op.join(self.static_dir, 'bar.css'))
+        self.assertEqual(mock_make.call_count, 1)
+        self.assertIs(scss_inst.import_cache.__class__,
+                      flask_scss.ImportCache)
+
+    def test_imports_are_resolved_through_a_directory_index(self):
+        self.set_layout()
+        vendor = op.join(self.test_data, 'vendor')
+        os.makedirs(op.join(vendor, 'lib'))
+        self.app.config['SCSS_LOAD_PATHS'] = [vendor]
+        scss_path = self.create_asset_file(
+            'foo.scss', content="@import \"lib/module\";")
+        with open(op.join(vendor, 'lib', '_module.scss'), 'w') as module:
+            module.write(TEST_PARTIAL)
+        for folder in (vendor, op.join(vendor, 'lib'), self.asset_dir):
+            os.utime(folder, (time.time() - 10, time.time() - 10))
+        css_path = op.join(self.static_dir, 'foo.css')
+        scss_inst = flask_scss.Scss(self.app)
+        self.assertIn('.test', scss_inst.compile_scss(scss_path, css_path))
+
+        scss_inst.import_cache.index_ttl = 0
+        with patch.object(flask_scss.DirectoryIndex, 'list',
+                          wraps=flask_scss.DirectoryIndex.list) as mock_list:
+            scss_inst.compile_scss(scss_path, op.join(self.static_dir,
+                                                      'bar.css'))
+        self.assertEqual(mock_list.call_count, 0)
+
+        # A new file is found once its directory changed
+        with open(op.join(vendor, 'lib', '_other.scss'), 'w') as other:
+            other.write(".other{color: white;}")
+        self.create_asset_file('foo.scss', content="@import \"lib/other\";")
+        self.assertIn('.other', scss_inst.compile_scss(
+            scss_path, op.join(self.static_dir, 'baz.css')))
+
+    def test_lru_cache_evicts_least_recently_used_values(self):
+        cache = flask_scss.LRUCache(max_entries=3, max_bytes=10)
+        cache['a'] = 'xxx'
+        cache['b'] = 'xxx'
+        cache['c'] = 'xxx'
+        self.assertEqual(cache.get('a'), 'xxx')
+        cache['d'] = 'xxx'
+        self.assertNotIn('b', cache)
+        cache['e'] = 'xxxxxxx'
+        self.assertEqual(cache.keys(), ['d', 'e'])
+        cache['f'] = 'x' * 20
+        self.assertEqual(cache.keys(), ['f'])
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats(), {'entries': 1, 'bytes': 20,
+                                         'hits': 1, 'misses': 1,
+                                         'evictions': 5})
+
+    def test_in_memory_css_is_bounded_and_recompiled_when_evicted(self):
+        self.set_layout()
+        self.app.config['SCSS_IN_MEMORY'] = True
+        self.app.config['SCSS_MEMORY_MAX_ENTRIES'] = 1
+        self.create_asset_file('foo.scss')
+        self.create_asset_file('bar.scss', content=TEST_PARTIAL)
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        self.assertEqual(len(scss_inst.memory), 1)
+        self.assertEqual(scss_inst.stats()['memory']['css']['evictions'], 1)
+        self.assertFalse(scss_inst.has_output('bar.css')
+                         and scss_inst.has_output('foo.css'))
+
+    def test_deleted_partials_and_imports_are_forgotten(self):
+        self.set_layout()
+        vendor = op.join(self.test_data, 'vendor')
+        os.makedirs(vendor)
+        self.app.config['SCSS_LOAD_PATHS'] = [vendor]
+        module = op.join(vendor, '_module.scss')
+        with open(module, 'w') as module_file:
+            module_file.write(".module{color: blue;}")
+        self.create_asset_file(
+            'foo.scss', content="@import \"test\";\n@import \"module\";")
+        partial = self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        self.assertEqual(len(scss_inst.import_cache.sources), 2)
+        os.remove(module)
+        os.remove(partial)
+        scss_inst.discover_scss()
+        self.assertEqual(sorted(scss_inst.changed_partials()),
+                         sorted([partial, op.realpath(module)]))
+        self.assertEqual(scss_inst.partials, {})
+        self.assertEqual(scss_inst.imports, {})
+        self.assertEqual(len(scss_inst.import_cache.sources), 0)
+
+    def test_worker_compilers_are_bounded_by_the_sources_limits(self):
+        self.set_layout()
+        scss_path = self.create_asset_file('foo.scss',
+                                           content=SCSS_CONTENT_WITH_PARTIAL)
+        self.create_asset_file('_test.scss', content=TEST_PARTIAL)
+        self.app.config['SCSS_SOURCES_MAX_ENTRIES'] = 1
+        self.app.config['SCSS_SOURCES_MAX_BYTES'] = 1000
+        scss_inst = flask_scss.Scss(self.app)
+        self.assertEqual(scss_inst.import_cache.sources.max_entries, 1)
+        with patch.dict(flask_scss._worker_compilers, clear=True):
+            css, imported, shadows, duration, error = \
+                flask_scss._compile_in_worker(scss_inst.compiler_options,
+                                              scss_path,
+                                              scss_inst.sources_limits)
+            self.assertIsNone(error)
+            compiler, = flask_scss._worker_compilers.values()
+            sources = flask_scss._import_cache(compiler).sources
+            self.assertEqual((sources.max_entries, sources.max_bytes),
+                             (1, 1000))
+
+    def test_deleted_assets_drop_their_locks_and_statistics(self):
+        self.set_layout()
+        self.app.config['SCSS_BUDGETS'] = {'*.css': {'rules': 0}}
+        scss_path = self.create_asset_file('foo.scss')
+        scss_inst = flask_scss.Scss(self.app)
+        scss_inst.update_scss()
+        self.assertIn(scss_path, scss_inst.compile_stats)
+        self.assertIn(scss_path, scss_inst.locks)
+        self.assertIn('foo.css', scss_inst.over_budget)
+        os.remove(scss_path)
+        scss_inst.discover_scss()
+        self.assertEqual(scss_inst.compile_stats, {})
+        self.assertEqual(scss_inst.locks, {})
+        self.assertEqual(scss_inst.metrics, {})
+        self.assertEqual(scss_inst.over_budget, {})
+
+    def test_css_metrics_count_rules_and_selectors(self):
+        metrics = flask_scss.css_metrics(
+            "/* a { } */ a, b > c { color: red; }\n"
+            "@media print { .d { color: blue; } }\n")
+        self.assertEqual(metrics['rules'], 2)
+        self.assertEqual(metrics['selectors'], 3)
+        self.assertGreater(metrics['bytes'], 0)
+        self.assertGreater(metrics['gzip_bytes'], 0)
+
+    def test_build_fails_when_a_budget_is_exceeded(self):
+        self.set_layout()
+        self.create_asset_file('foo.scss')
+        self.create_asset_file('pages/bar.scss',
+                               content=".a, .b { color: red; } .c { x: y; }")
+        report_path = op.join(self.test_data, 'report.jsonl')
+        flask_app = Flask('__main__', root_path=self.test_data)
+        flask_app.config['SCSS_BUDGETS'] = {'pages/*.css': {'selectors': 2}}
+        flask_app.config['SCSS_REPORT_FILE'] = report_path
+        scss_inst = flask_scss.Scss(flask_app)
+        runner = flask_app.test_cli_runner()
+        result = runner.invoke(args=['scss', 'build'])
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn('pages/bar.css: selectors 3 > 2', result.output)
+        self.assertEqual(scss_inst.stats()['metrics']['pages/bar.css']
+                         ['rules'], 2)
+
+        self.create_asset_file('pages/bar.scss', content=".a { color: red; }")
+        result = runner.invoke(args=['scss', 'build'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        with open(report_path) as report_file:
+            reports = [json.loads(line) for line in report_file]
+        self.assertEqual(len(reports), 2)
+        self.assertEqual(reports[0]['over_budget'].keys(),
+                         set(['pages/bar.css']))
+        self.assertEqual(reports[1]['css']['pages/bar.css']['selectors'], 1)
+        self.assertIn('foo.css', reports[1]['css'])
+
+        flask_app.config['SCSS_BUDGETS'] = {'*.css': {'size': 10}}
+        self.assertRaises(ValueError, flask_scss.Scss, flask_app)
+
+    def test_directory_index_does_not_follow_symlinked_directories(self):
+        vendor = op.join(self.test_data, 'vendor')
+        os.makedirs(op.join(vendor, 'lib'))
+        with open(op.join(vendor, 'lib', '_module.scss'), 'w') as module:
+            module.write(TEST_PARTIAL)
+        os.symlink(os.pardir, op.join(vendor, 'lib', 'a'))
+        os.symlink(os.pardir, op.join(vendor, 'lib', 'b'))
+        index = flask_scss.DirectoryIndex(vendor)
+        index.validate()
+        self.assertEqual(sorted(index.dirs),
+                         [vendor, op.join(vendor, 'lib')])
+        self.assertTrue(index.may_contain('lib/_module.scss'))
+        self.assertTrue(index.may_contain('lib/a/lib/_module.scss'))
+        self.assertFalse(index.may_contain('lib/_other.scss'))
+        self.assertFalse(index.may_contain('other/_module.scss'))
+
+        self.set_layout()
+        self.app.config['SCSS_LOAD_PATHS'] = [vendor]
+        scss_path = self.create_asset_file(
+            'foo.scss', content="@import \"lib/b/lib/module\";")
+        scss_inst = flask_scss.Scss(self.app)
+        self.assertIn('.test', scss_inst.compile_scss(
+            scss_path, op.join(self.static_dir, 'foo.css')))
+
+    def test_asset_locks_are_private_and_fall_back_on_thread_locks(self):
+        self.set_layout()
+        scss_inst = flask_scss.Scss(self.app)
+        lock_dir = scss_inst.lock_dir()
+        self.assertIn(flask_scss.tempfile.gettempdir(), lock_dir)
+        self.app.root_path = op.join(self.test_data, 'other')
+        self.assertNotEqual(flask_scss.Scss(self.app).lock_dir(), lock_dir)
+
+        lock = flask_scss.AssetLock(op.join(self.test_data, 'locks', 'a'))
+        with patch.object(flask_scss.os, 'open',
+                          side_effect=OSError(13, 'Permission denied')):
+            self.assertTrue(lock.acquire())
+            self.assertFalse(lock.acquire(blocking=False))
+            lock.release()
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_private_asset_locks_check_their_directory(self):
+        self.set_layout()
+        lock_dir = op.join(self.test_data, 'locks')
+        os.makedirs(lock_dir)
+        os.chmod(lock_dir, 0o755)
+        lock = flask_scss.AssetLock(op.join(lock_dir, 'a.lock'), private=True)
+        with lock:
+            self.assertIsNone(lock.fd)
+        self.assertFalse(op.exists(op.join(lock_dir, 'a.lock')))
+
+        os.chmod(lock_dir, 0o700)
+        with lock:
+            self.assertIsNotNone(lock.fd)
+
+        # A symbolic link planted as lock file is not followed
+        target = op.join(self.test_data, 'target')
+        os.symlink(target, op.join(lock_dir, 'b.lock'))
+        lock = flask_scss.AssetLock(op.join(lock_dir, 'b.lock'), private=True)
+        with lock:
+            self.assertIsNone(lock.fd)
+        self.assertFalse(op.exists(target))
+
+    def test_new_css_honours_the_umask_and_rewritten_css_keeps_its_mode(self):
+        self.set_layout()
+        css_path = op.join(self.static_dir, 'foo.css')
+        umask = os.umask(0o077)
+        try:
+            flask_scss._write_if_changed(css_path, b'a {}')
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(css_path).st_mode & 0o777, 0o600)
+        os.chmod(css_path, 0o640)
+        flask_scss._write_if_changed(css_path, b'b {}')
+        self.assertEqual(os.stat(css_path).st_mode & 0o777, 0o640)
+
     def test_it_sets_up_refresh_hooks_if_application_is_in_test_mode(self):
         self.app.testing = True
         self.app.debug = False
@@ -377,6 +1434,59 @@ class ScssTest(unittest.TestCase):
         inst = flask_scss.Scss(self.app, load_paths=['bar', 'baz'])
         self.assertIn(pathlib.Path(inst.asset_dir), inst.compiler.search_path)
 
+    def test_output_style_defaults_to_nested_in_debug_mode(self):
+        self.app.debug = True
+        scss = flask_scss.Scss(self.app)
+        self.assertEqual(scss.compiler.output_style, 'nested')
+
+    def test_output_style_defaults_to_compressed_in_production(self):
+        self.app.debug = False
+        self.app.testing = False
+        scss = flask_scss.Scss(self.app)
+        self.assertEqual(scss.compiler.output_style, 'compressed')
+
+    def test_output_style_and_compiler_options_are_read_from_app_config(self):
+        self.app.config['SCSS_OUTPUT_STYLE'] = 'compact'
+        self.app.config['SCSS_COMPILER_OPTIONS'] = {'live_errors': True}
+        scss = flask_scss.Scss(self.app)
+        self.assertEqual(scss.compiler.output_style, 'compact')
+        self.assertTrue(scss.compiler.live_errors)
+
+    def test_extensions_of_the_compiler_options_follow_the_import_cache(self):
+        from scss.extension.compass import CompassExtension
+        from scss.extension.core import CoreExtension
+        self.set_layout()
+        self.app.config['SCSS_COMPILER_OPTIONS'] = {
+            'extensions': [CoreExtension, CompassExtension]}
+        scss_path = self.create_asset_file(
+            'foo.scss', content="a { color: darken(#fff, 10%); }")
+        scss = flask_scss.Scss(self.app)
+        self.assertEqual([extension.__class__ for extension
+                          in scss.compiler.extensions],
+                         [flask_scss.ImportCache, CoreExtension,
+                          CompassExtension])
+        self.assertIs(scss.import_cache, scss.compiler.extensions[0])
+        self.assertIn('#e6e6e6', scss.compile_scss(
+            scss_path, op.join(self.static_dir, 'foo.css')))
+
+    def test_reserved_compiler_options_are_rejected(self):
+        self.app.config['SCSS_COMPILER_OPTIONS'] = {'search_path': []}
+        self.assertRaises(ValueError, flask_scss.Scss, self.app)
+
+    def test_invalid_output_style_is_rejected(self):
+        self.app.config['SCSS_OUTPUT_STYLE'] = 'tiny'
+        self.assertRaises(ValueError, flask_scss.Scss, self.app)
+
+    def test_compressed_output_style_strips_whitespace(self):
+        self.set_layout()
+        self.app.config['SCSS_OUTPUT_STYLE'] = 'compressed'
+        scss_path = self.create_asset_file('foo.scss')
+        css_path = op.join(self.static_dir, 'foo.css')
+        flask_scss.Scss(self.app).compile_scss(scss_path, css_path)
+        with open(css_path) as css_file:
+            self.assertEqual(css_file.read(),
+                             "a{color:red;text-decoration:none}\n")
+
     def test_compile_scss_creates_subfolders_if_necessary(self):
         self.set_layout()
         asset_scss_dir = op.join(self.test_data, 'assets', 'bar')